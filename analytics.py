@@ -0,0 +1,228 @@
+import sqlite3, threading, os
+from datetime import datetime, timedelta, timezone
+
+# per order: stall, bucket and outcome; archived orders still in main
+# (a move cut short between the two files) are counted once
+ORDER_FACTS = """
+    SELECT stall_id, strftime('%Y-%m-%d %H:00', created_at) AS hour, status,
+           created_at, accepted_at, finished_at,
+           COALESCE(total_price, price, 0) AS revenue
+    FROM main.orders
+"""
+ARCHIVE_FACTS = """
+    UNION ALL
+    SELECT stall_id, strftime('%Y-%m-%d %H:00', created_at), status,
+           created_at, accepted_at, {finished},
+           COALESCE(total_price, price, 0)
+    FROM archive.orders WHERE id NOT IN (SELECT id FROM main.orders)
+"""
+
+ITEM_FACTS = """
+    SELECT o.stall_id, strftime('%Y-%m-%d %H:00', o.created_at) AS hour,
+           oi.order_id, oi.product_id, oi.quantity
+    FROM main.order_items oi JOIN main.orders o ON o.id = oi.order_id
+    WHERE o.status = 'ready'
+"""
+ARCHIVE_ITEM_FACTS = """
+    UNION ALL
+    SELECT o.stall_id, strftime('%Y-%m-%d %H:00', o.created_at),
+           oi.order_id, oi.product_id, oi.quantity
+    FROM archive.order_items oi JOIN archive.orders o ON o.id = oi.order_id
+    WHERE o.status = 'ready' AND o.id NOT IN (SELECT id FROM main.orders)
+"""
+
+
+def hour_bucket(when):
+    return when.strftime("%Y-%m-%d %H:00")
+
+
+class SalesRollups:
+    # Owner sales numbers read from the hourly rollup tables of db.py
+    # migration 9 (sales_hourly, product_sales_hourly). The triggers there
+    # keep them current on every status change; backfill() rebuilds them
+    # from the orders already in the database and the archive file, in two
+    # INSERT ... SELECT ... GROUP BY statements. Dashboard queries are
+    # primary key range scans, so their cost follows the number of hours
+    # asked for, not the number of orders.
+    #
+    # Revenue is the order total for ready orders; per product it is
+    # quantity * current price, like the order summaries. Prep and wait
+    # times only exist for orders finished after the migration
+    # (finished_at).
+
+    def __init__(self, database, archive_path):
+        self.database = database
+        self.archive_path = archive_path
+        self._lock = threading.Lock()
+        self._stats = {"backfills": 0, "backfill_rows": 0, "backfill_ms": None}
+
+    # ---------- backfill ----------
+
+    def ensure_backfilled(self):
+        # once per database; the first worker to start does it
+        db = sqlite3.connect(self.database, timeout=30, isolation_level=None)
+        try:
+            state = db.execute("SELECT backfilled_at FROM sales_rollup_state WHERE id = 1").fetchone()
+            if state and state[0] is None:
+                self._backfill(db, only_once=True)
+        finally:
+            db.close()
+
+    def backfill(self):
+        # recompute everything; safe to run again at any time
+        db = sqlite3.connect(self.database, timeout=30, isolation_level=None)
+        try:
+            return self._backfill(db)
+        finally:
+            db.close()
+
+    def _attach_archive(self, db):
+        # the archive's finished_at column, or None without an archive
+        if not os.path.exists(self.archive_path):
+            return None
+        db.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        columns = [row[1] for row in db.execute("PRAGMA archive.table_info(orders)")]
+        if not columns:
+            db.execute("DETACH DATABASE archive")
+            return None
+        return "finished_at" if "finished_at" in columns else "NULL"
+
+    def _backfill(self, db, only_once=False):
+        started = datetime.now(timezone.utc)
+        db.execute("PRAGMA busy_timeout=10000")
+        finished = self._attach_archive(db)
+        orders = ORDER_FACTS + (ARCHIVE_FACTS.format(finished=finished) if finished else "")
+        items = ITEM_FACTS + (ARCHIVE_ITEM_FACTS if finished else "")
+
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if only_once:
+                state = db.execute("SELECT backfilled_at FROM sales_rollup_state WHERE id = 1").fetchone()
+                if state[0] is not None:
+                    db.rollback()
+                    return 0
+            db.execute("DELETE FROM main.sales_hourly")
+            db.execute("DELETE FROM main.product_sales_hourly")
+            rows = db.execute("""
+                INSERT INTO main.sales_hourly
+                    (stall_id, hour, placed, completed, rejected, cancelled, revenue,
+                     prep_seconds, prep_count, wait_seconds, wait_count)
+                SELECT stall_id, hour, COUNT(*),
+                       SUM(status = 'ready'), SUM(status = 'rejected'), SUM(status = 'cancelled'),
+                       SUM(CASE WHEN status = 'ready' THEN revenue ELSE 0 END),
+                       COALESCE(SUM(CASE WHEN status = 'ready' AND accepted_at IS NOT NULL AND finished_at IS NOT NULL
+                                    THEN (julianday(finished_at) - julianday(accepted_at)) * 86400 END), 0),
+                       SUM(status = 'ready' AND accepted_at IS NOT NULL AND finished_at IS NOT NULL),
+                       COALESCE(SUM(CASE WHEN status = 'ready' AND finished_at IS NOT NULL
+                                    THEN (julianday(finished_at) - julianday(created_at)) * 86400 END), 0),
+                       SUM(status = 'ready' AND finished_at IS NOT NULL)
+                FROM (%s)
+                WHERE hour IS NOT NULL
+                GROUP BY stall_id, hour
+            """ % orders).rowcount
+            rows += db.execute("""
+                INSERT INTO main.product_sales_hourly (stall_id, hour, product_id, quantity, revenue, orders)
+                SELECT i.stall_id, i.hour, i.product_id, SUM(i.quantity),
+                       SUM(i.quantity * COALESCE(p.price, 0)), COUNT(DISTINCT i.order_id)
+                FROM (%s) i
+                LEFT JOIN main.products p ON p.id = i.product_id
+                WHERE i.hour IS NOT NULL
+                GROUP BY i.stall_id, i.hour, i.product_id
+            """ % items).rowcount
+            db.execute("UPDATE main.sales_rollup_state SET backfilled_at = ? WHERE id = 1", (started.isoformat(),))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        elapsed = (datetime.now(timezone.utc) - started).total_seconds() * 1000
+        with self._lock:
+            self._stats["backfills"] += 1
+            self._stats["backfill_rows"] = rows
+            self._stats["backfill_ms"] = round(elapsed, 1)
+        return rows
+
+    # ---------- dashboard ----------
+
+    def window(self, days):
+        # [start, end) hour buckets covering the last `days` days
+        now = datetime.now(timezone.utc)
+        return hour_bucket(now - timedelta(days=days)), hour_bucket(now + timedelta(hours=1))
+
+    def summary(self, db, stall_id, start, end):
+        row = db.execute("""
+            SELECT COALESCE(SUM(placed), 0), COALESCE(SUM(completed), 0),
+                   COALESCE(SUM(rejected), 0), COALESCE(SUM(cancelled), 0),
+                   COALESCE(SUM(revenue), 0),
+                   SUM(prep_seconds) / NULLIF(SUM(prep_count), 0),
+                   SUM(wait_seconds) / NULLIF(SUM(wait_count), 0)
+            FROM sales_hourly
+            WHERE stall_id = ? AND hour >= ? AND hour < ?
+        """, (stall_id, start, end)).fetchone()
+        placed = row[0]
+        return {
+            "orders": placed,
+            "completed": row[1],
+            "rejected": row[2],
+            "cancelled": row[3],
+            "revenue": row[4],
+            "avg_order": round(row[4] / row[1], 2) if row[1] else None,
+            "avg_prep_minutes": round(row[5] / 60, 1) if row[5] is not None else None,
+            "avg_wait_minutes": round(row[6] / 60, 1) if row[6] is not None else None,
+            "cancellation_rate": round(row[3] / placed, 4) if placed else None,
+            "rejection_rate": round(row[2] / placed, 4) if placed else None,
+        }
+
+    def series(self, db, stall_id, start, end, by="day"):
+        # by="day": one row per day; by="hour": one row per hour of the day
+        # summed over the window (the stall's busy hours)
+        key = "substr(hour, 1, 10)" if by == "day" else "substr(hour, 12, 2)"
+        rows = db.execute("""
+            SELECT %s AS bucket, SUM(placed), SUM(completed), SUM(cancelled), SUM(revenue),
+                   SUM(wait_seconds) / NULLIF(SUM(wait_count), 0)
+            FROM sales_hourly
+            WHERE stall_id = ? AND hour >= ? AND hour < ?
+            GROUP BY bucket ORDER BY bucket
+        """ % key, (stall_id, start, end)).fetchall()
+        return [
+            {
+                "bucket": r[0], "orders": r[1], "completed": r[2], "cancelled": r[3], "revenue": r[4],
+                "avg_wait_minutes": round(r[5] / 60, 1) if r[5] is not None else None,
+            }
+            for r in rows
+        ]
+
+    def top_products(self, db, stall_id, start, end, limit=10):
+        rows = db.execute("""
+            SELECT s.product_id, COALESCE(p.product_name, '[Deleted Product]'),
+                   s.quantity, s.revenue, s.orders
+            FROM (
+                SELECT product_id, SUM(quantity) AS quantity, SUM(revenue) AS revenue, SUM(orders) AS orders
+                FROM product_sales_hourly
+                WHERE stall_id = ? AND hour >= ? AND hour < ?
+                GROUP BY product_id
+            ) s
+            LEFT JOIN products p ON p.id = s.product_id
+            ORDER BY s.revenue DESC, s.quantity DESC
+            LIMIT ?
+        """, (stall_id, start, end, limit)).fetchall()
+        return [
+            {"product_id": r[0], "name": r[1], "quantity": r[2], "revenue": r[3], "orders": r[4]}
+            for r in rows
+        ]
+
+    def report(self, db, stall_id, days=7):
+        start, end = self.window(days)
+        return {
+            "days": days,
+            "from": start,
+            "to": end,
+            "summary": self.summary(db, stall_id, start, end),
+            "daily": self.series(db, stall_id, start, end, "day"),
+            "hours": self.series(db, stall_id, start, end, "hour"),
+            "products": self.top_products(db, stall_id, start, end),
+        }
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
@@ -1,19 +1,37 @@
-from flask import Flask, render_template, request, session, redirect, jsonify, flash, url_for
+from flask import Flask, Response, render_template, request, session, redirect, jsonify, flash, url_for, g, has_app_context, send_from_directory
+from flask import before_render_template, template_rendered
 from functools import wraps
-from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta, timezone
-import sqlite3, jwt, os, uuid, math
+import sqlite3, jwt, os, uuid, json, time, threading, cProfile
+from pool import ConnectionPool
+from db import init_db
+from changes import ChangeNotifier
+from scheduler import ReadyScheduler
+from cache import ReadCache, LocalVersions, SQLiteVersions
+from auth import RevocationList, SessionJanitor, cap_sessions, token_digest, utcnow
+from passwords import PasswordHasher, HasherBusy
+from sessions import ServerSessionInterface, LocalStore, SQLiteStore
+from images import ImageStore, BadImage, is_hashed
+from archive import OrderArchive
+from analytics import SalesRollups
+from stock import OutOfStock, reserve, release
+from writer import Writer
+from metrics import Metrics
+from compress import compress_response
+from fragments import FragmentCache
 
 def hash_pw(pw):
-    return generate_password_hash(pw)
+    return hasher.hash(pw)
 
+# (matches, new_hash); new_hash means the stored hash uses an old cost
 def check_pw(raw_password, hashed_password):
-    return check_password_hash(hashed_password, raw_password)
-def create_access_token(user):
+    return hasher.verify(raw_password, hashed_password)
+def create_access_token(user, sid=None):
     payload = {
         "user_id": user["id"],
         "username": user["username"],
         "role": user["role"],
+        "sid": sid,
         "exp": int((datetime.now(timezone.utc) + timedelta(minutes=JWT_ACCESS_EXP)).timestamp())
     }
     return jwt.encode(payload, JWT_SECRET, algorithm="HS256")
@@ -28,101 +46,256 @@ def create_refresh_token(user_id):
     token = jwt.encode(payload, JWT_SECRET, algorithm="HS256")
     return token, sid
 
-def update_ready_orders():
-
-    db = get_db()
-
-    orders = db.execute("""
-        SELECT * FROM orders
-        WHERE status = 'accepted'
-    """).fetchall()
-
-    now = datetime.now()
-
-    for o in orders:
-        if not o["accepted_at"] or not o["prep_time"]:
-            continue
+# ================= TOKEN SEQUENCE =================
+def token_day():
+    return datetime.now().date().isoformat() if TOKEN_DAILY_RESET else ""
+
+# must run inside the BEGIN IMMEDIATE transaction that inserts the order
+def next_token(db, stall_id):
+    day = token_day()
+    token = db.execute("""
+        INSERT INTO stall_sequences (stall_id, last_token, token_day)
+        VALUES (?, 1, ?)
+        ON CONFLICT(stall_id) DO UPDATE SET
+            last_token = CASE
+                WHEN token_day = excluded.token_day THEN last_token + 1
+                ELSE (
+                    SELECT COALESCE(MAX(token), 0) + 1 FROM orders
+                    WHERE stall_id = excluded.stall_id
+                    AND token_day = excluded.token_day
+                )
+            END,
+            token_day = excluded.token_day
+        RETURNING last_token
+    """, (stall_id, day)).fetchone()[0]
+    return token, day
 
-        ready_time = datetime.fromisoformat(o["accepted_at"]) + timedelta(minutes=o["prep_time"])
-
-        if now >= ready_time:
-            db.execute(
-                "UPDATE orders SET status = 'ready' WHERE id = ?",
-                (o["id"],)
-            )
-
-    db.commit()
-    
 def current_user():
+    # API clients send the access token; pages fall back to the cookie session
+    token = bearer_token()
+    if token:
+        data, error = verify_access_token(token)
+        if error:
+            return None
+        return {"id": data["user_id"], "user_id": data["user_id"], "user": data["user_id"],
+                "username": data["username"], "role": data["role"]}
+
     sid = session.get("active_sid")
     if not sid:
         return None
     sessions = session.get("sessions", {})
     user = sessions.get(sid)
-    user = dict(user)
     if not user:
         return None
     user = dict(user)
 
-    # 🔥 ADD THIS (backward compatibility ke liye)
+    # sessions written before "user" existed carry id or user_id
     if "user" not in user:
-        # id / user_id jo bhi hai uske hisaab se
         if "id" in user:
             user["user"] = user["id"]
         elif "user_id" in user:
             user["user"] = user["user_id"]
     return user
 
-#Eta timer
-def apply_eta_queue(orders):
-    now = datetime.now(timezone.utc)
-
-    accepted = [
-        o for o in orders
-        if o["status"] == "accepted" and o["accepted_at"]
-    ]
-
-    accepted.sort(key=lambda o: o["accepted_at"])
-
-    cumulative_minutes = 0
-    final = []
+ORDERS_PAGE_SIZE = 50
+
+# orders still in the stall's hands; they are never paged away
+OPEN_STATUSES = ("pending", "accepted")
+OPEN_FILTER = " AND o.status IN ('pending', 'accepted')"
+
+# The first page is every open order, however old, plus the newest `limit`
+# other orders; later pages are keyset pages of the other orders on o.id
+# DESC (pass next_cursor() of the previous page as `before`). `sql` is a
+# SELECT o.* ... WHERE ... without ORDER BY.
+def order_page(sql, params, before=None, limit=None):
+    if before is None and limit is None:
+        return sql, list(params)
+    done = "SELECT * FROM (%s AND o.status NOT IN ('pending', 'accepted')" % sql
+    done_params = list(params)
+    if before is not None:
+        done += " AND o.id < ?"
+        done_params.append(before)
+    done += " ORDER BY o.id DESC"
+    if limit is not None:
+        done += " LIMIT ?"
+        done_params.append(limit)
+    done += ")"
+    if before is not None:
+        return done, done_params
+    return sql + OPEN_FILTER + " UNION ALL " + done, list(params) + done_params
+
+def next_cursor(orders, limit):
+    done = [o["id"] for o in orders if o["status"] not in OPEN_STATUSES]
+    if limit is None or len(done) < limit:
+        return None
+    return min(done)
+
+# owner dashboard rows; order_ids narrows it down to the rows that changed
+def owner_order_rows(db, owner_id, order_ids=None, before=None, limit=None):
+    params = [owner_id]
+    extra = ""
+    if order_ids is not None:
+        extra = " AND o.id IN (%s)" % ",".join("?" * len(order_ids))
+        params += list(order_ids)
+    page, params = order_page("""
+        SELECT o.* FROM orders o
+        JOIN stalls s ON o.stall_id = s.id
+        WHERE s.owner_id = ?
+        AND o.is_deleted = 0
+        %s""" % extra, params, before, limit)
 
-    for o in accepted:
-        o = dict(o)
-        prep = int(o["prep_time"])
-        
-        accepted_at = datetime.fromisoformat(o["accepted_at"])
+    # summaries are kept by refresh_order_summaries()
+    return db.execute("""
+    SELECT
+        o.id,
+        o.stall_id,
+        o.token,
+        o.status,
+        o.accepted_at,
+        o.total_price,
+        o.items_summary AS items,
+        o.prep_total AS prep_time
+    FROM (%s) o
+    ORDER BY o.owner_rank, o.id DESC
+    """ % page, params).fetchall()
+
+# order_ids narrows it down to those hot orders (no archive lookup)
+def customer_order_rows(db, customer_id, before=None, limit=None, order_ids=None):
+    extra = ""
+    params = [customer_id]
+    if order_ids is not None:
+        extra = " AND o.id IN (%s)" % ",".join("?" * len(order_ids))
+        params += list(order_ids)
+    page, params = order_page("""
+        SELECT o.* FROM orders o
+        WHERE o.customer_id = ?
+        %s""" % extra, params, before, limit)
+
+    rows = db.execute("""
+        SELECT
+        o.id,
+        o.stall_id,
+        o.token,
+        o.status,
+        COALESCE(o.total_price, o.price) AS total_price,
+        o.accepted_at,
+        o.items_summary AS item,
+        o.prep_total AS prep_time,
+        o.customer_rank
+    FROM (%s) o
+    ORDER BY o.customer_rank, o.id DESC
+    """ % page, params).fetchall()
+    if order_ids is not None:
+        return rows
+
+    # the archive only holds finished orders: they belong on this page
+    # below `before` and, when the page is already full, above its oldest
+    # hot finished order
+    open_rows = [r for r in rows if r["status"] in OPEN_STATUSES]
+    done = [r for r in rows if r["status"] not in OPEN_STATUSES]
+    full = limit is not None and len(done) >= limit
+    after = min(r["id"] for r in done) if full else None
+    hot = {r["id"] for r in rows}
+    old = [r for r in archive.customer_rows(customer_id, before, after, limit) if r["id"] not in hot]
+    if not old:
+        return rows
+    done = sorted(done + old, key=lambda r: r["id"], reverse=True)[:limit]
+    return sorted(open_rows + done, key=lambda r: (r["customer_rank"], -r["id"]))
+
+# recompute the materialized total / item list / prep time of some orders;
+# runs in the caller's transaction after order_items or products change
+def refresh_order_summaries(db, order_ids):
+    order_ids = list(order_ids)
+    for i in range(0, len(order_ids), 500):
+        chunk = order_ids[i:i + 500]
+        db.execute("""
+            UPDATE orders SET
+                total_price = (
+                    SELECT SUM(oi.quantity * p.price) FROM order_items oi
+                    JOIN products p ON p.id = oi.product_id
+                    WHERE oi.order_id = orders.id
+                ),
+                items_summary = (
+                    SELECT GROUP_CONCAT(line) FROM (
+                        SELECT COALESCE(p.product_name, '[Deleted Product]') || ' x ' || oi.quantity AS line
+                        FROM order_items oi
+                        LEFT JOIN products p ON p.id = oi.product_id
+                        WHERE oi.order_id = orders.id
+                        ORDER BY oi.id
+                    )
+                ),
+                prep_total = (
+                    SELECT SUM(p.prep_time * oi.quantity) FROM order_items oi
+                    JOIN products p ON p.id = oi.product_id
+                    WHERE oi.order_id = orders.id
+                )
+            WHERE id IN (%s)
+        """ % ",".join("?" * len(chunk)), chunk)
+
+# (order ids, customer ids) of the orders that contain a product
+def orders_with_product(db, pid):
+    rows = db.execute("""
+        SELECT o.id, o.customer_id FROM orders o
+        WHERE o.id IN (SELECT order_id FROM order_items WHERE product_id=?)
+    """, (pid,)).fetchall()
+    return [r[0] for r in rows], [r[1] for r in rows]
+
+# every item of the given orders in one query (per 500 ids), grouped by order
+def load_order_items(db, order_ids):
+    items = {order_id: [] for order_id in order_ids}
+    ids = list(items)
+
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        rows = db.execute("""
+            SELECT
+            oi.order_id,
+            COALESCE(p.product_name, '[Deleted Product]') AS product_name,
+            oi.quantity,
+            p.image,
+            p.image_width,
+            p.image_height
+            FROM order_items oi
+            LEFT JOIN products p ON oi.product_id = p.id
+            WHERE oi.order_id IN (%s)
+            ORDER BY oi.order_id, oi.id
+        """ % ",".join("?" * len(chunk)), chunk).fetchall()
 
-        cumulative_minutes += prep
-        ready_at = accepted_at + timedelta(minutes=cumulative_minutes)
-        remaining = max(0,math.ceil((ready_at - now).total_seconds() / 60))
-        o["ready_at"] = ready_at.isoformat()
-        o["remaining"] = remaining
-        final.append(o)
+        for row in rows:
+            items[row["order_id"]].append(row)
 
-    for o in orders:
-        if o["status"] != "accepted":
-            o = dict(o)
-            o["remaining"] = None
-            o["ready_at"] = None
-            final.append(o)
+    return items
 
-    return final
+# (claims, None) for a good access token, (None, error) otherwise.
+# Signature and expiry are checked locally; logout is the only thing that
+# needs a lookup, and that is mostly a bloom filter miss.
+def verify_access_token(token):
+    try:
+        data = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+    except jwt.ExpiredSignatureError:
+        return None, "Token expired"
+    except Exception:
+        return None, "Invalid token"
+    if data.get("sid") and revocations.is_revoked(data["sid"]):
+        return None, "Token revoked"
+    return data, None
 
+def bearer_token():
+    auth = request.headers.get("Authorization", "")
+    if auth.startswith("Bearer "):
+        return auth[7:]
+    return None
 
 def jwt_required(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        auth = request.headers.get("Authorization", "").replace("Bearer ", "")
+        auth = bearer_token()
         if not auth:
             return jsonify({"error": "Token missing"}), 401
-        try:
-            data = jwt.decode(auth, JWT_SECRET, algorithms=["HS256"])
-            request.jwt_user = data
-        except jwt.ExpiredSignatureError:
-            return jsonify({"error": "Token expired"}), 401
-        except Exception:
-            return jsonify({"error": "Invalid token"}), 401
+        data, error = verify_access_token(auth)
+        if error:
+            return jsonify({"error": error}), 401
+        request.jwt_user = data
 
         return fn(*args, **kwargs)
     return wrapper
@@ -132,10 +305,297 @@ app.secret_key = os.environ.get("SECRET_KEY", "dev-key")
 JWT_SECRET = os.environ.get("JWT_SECRET", app.secret_key)
 JWT_ACCESS_EXP = 15        # minutes
 JWT_REFRESH_EXP = 7        # days
+# live refresh tokens per user; logging in on one more device drops the oldest
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 10))
+# customer page waits on /current_tokens instead of polling every 10 s;
+# only worth it with async or threaded workers
+TOKENS_LONG_POLL = os.environ.get("TOKENS_LONG_POLL", "0") == "1"
+# owner dashboard follows /owner_orders/stream instead of polling
+# /owner_orders_partial; every open stream holds a worker thread, so only
+# with async or threaded workers (e.g. under asgi.py)
+ORDER_STREAM = os.environ.get("ORDER_STREAM", "0") == "1"
+# restart every stall's tokens at 1 each day
+TOKEN_DAILY_RESET = os.environ.get("TOKEN_DAILY_RESET", "0") == "1"
+DATABASE = os.environ.get("DATABASE", "database.db")
+
+# creates missing tables and runs pending migrations (PRAGMA user_version)
+init_db(DATABASE)
+
+pool = ConnectionPool(
+    DATABASE,
+    size=int(os.environ.get("DB_POOL_SIZE", 8)),
+    timeout=10,
+)
+
+# per-endpoint latency, SQL and render metrics for /metrics; statements
+# slower than SLOW_QUERY_MS, or one statement run SQL_REPEAT_LIMIT times in
+# a request (N+1), are counted and listed on /health/sql
+metrics = Metrics(
+    slow_ms=float(os.environ.get("SLOW_QUERY_MS", 50)),
+    repeat=int(os.environ.get("SQL_REPEAT_LIMIT", 10)),
+)
+# requests sent with "X-Profile: 1" write a cProfile dump here; unset = off
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+profile_lock = threading.Lock()
+
+# one pooled connection per app context; close() inside a route is a no-op
+# and the connection goes back to the pool on teardown
 def get_db():
-    conn = sqlite3.connect("database.db", timeout=10, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+    if not has_app_context():
+        return pool.acquire()
+    if "db" not in g:
+        g.db = pool.acquire()
+        g.db.bound = True
+        stats = g.get("request_stats")
+        if stats is not None:
+            g.db.set_trace_callback(metrics.tracer(stats))
+            g.db.on_execute = metrics.timer(stats)
+    return g.db
+
+# every write of the ordering / login paths goes through writer.run();
+# WRITE_MODE=thread group-commits per worker, WRITE_MODE=socket funnels
+# all workers into one writer (see writer.py)
+writer = Writer(
+    pool,
+    mode=os.environ.get("WRITE_MODE", "direct"),
+    batch=int(os.environ.get("WRITE_BATCH", 64)),
+    socket_path=os.environ.get("WRITE_SOCKET", "writer.sock"),
+    authkey=app.secret_key.encode(),
+)
+
+# order changes, per stall; feeds /owner_orders/stream
+changes = ChangeNotifier()
+SSE_KEEPALIVE = 15   # seconds
+
+# stall list, menus and owner -> stall name. The invalidation versions
+# (and so every ETag) are shared between gunicorn workers through CACHE_DB;
+# with per-process versions (CACHE_BACKEND=local) a worker that never saw
+# a write would keep answering 304, so that is only for a single worker
+read_cache = ReadCache(
+    LocalVersions() if os.environ.get("CACHE_BACKEND", "sqlite") == "local"
+    else SQLiteVersions(os.environ.get("CACHE_DB", "cache.db")),
+    maxsize=int(os.environ.get("CACHE_SIZE", 512)),
+    ttl=int(os.environ.get("CACHE_TTL", 300)),
+)
+
+# sessions ended by /logout; checked by /refresh and every access token
+revocations = RevocationList(pool)
+
+# deletes expired / long-revoked refresh tokens in the background
+janitor = SessionJanitor(
+    pool,
+    revocations,
+    interval=int(os.environ.get("SESSION_SWEEP_INTERVAL", 600)),
+    max_sessions=MAX_SESSIONS,
+    grace=timedelta(minutes=JWT_ACCESS_EXP),
+)
+
+# the session cookie only carries a signed id; SESSION_BACKEND=cookie
+# keeps Flask's signed-cookie sessions, local is for a single worker
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "sqlite")
+if SESSION_BACKEND != "cookie":
+    app.session_interface = ServerSessionInterface(
+        SQLiteStore(os.environ.get("SESSION_DB", "sessions.db"))
+        if SESSION_BACKEND == "sqlite" else LocalStore(),
+        ttl=JWT_REFRESH_EXP * 24 * 3600,
+    )
+
+# finished orders older than ARCHIVE_AFTER_DAYS move to ARCHIVE_DB;
+# order_history still pages into them
+archive = OrderArchive(
+    DATABASE,
+    os.environ.get("ARCHIVE_DB", "archive.db"),
+    days=int(os.environ.get("ARCHIVE_AFTER_DAYS", 30)),
+    interval=int(os.environ.get("ARCHIVE_INTERVAL", 3600)),
+)
+
+# hourly sales rollups behind /owner/analytics, kept by triggers (db.py
+# migration 9); the orders from before that are counted once, here
+sales = SalesRollups(DATABASE, archive.path)
+sales.ensure_backfilled()
+
+# product images: content-hashed files plus WebP thumbnails, see /media
+images = ImageStore(
+    os.environ.get("UPLOAD_DIR", "static/uploads"),
+    workers=int(os.environ.get("THUMB_WORKERS", 2)),
+)
+MEDIA_MAX_AGE = 365 * 24 * 3600
+
+# password KDF off the request thread; PASSWORD_METHOD is any werkzeug
+# method string, e.g. "scrypt:65536:8:1" or "pbkdf2:sha256:600000", and
+# stored hashes are upgraded on the next successful login
+hasher = PasswordHasher(
+    method=os.environ.get("PASSWORD_METHOD", "scrypt"),
+    workers=int(os.environ.get("PASSWORD_WORKERS", 2)),
+    max_pending=int(os.environ.get("PASSWORD_QUEUE", 32)),
+)
+
+# forms posted by a browser get their page back when the hasher is busy
+HASHER_BUSY_PAGES = {
+    "register_owner": "register_owner.html",
+    "register_customer": "register_customer.html",
+}
+
+def wants_json():
+    return (request.is_json
+            or request.headers.get("X-Requested-With") == "XMLHttpRequest"
+            or request.accept_mimetypes.best == "application/json")
+
+@app.errorhandler(HasherBusy)
+def hasher_busy(exc):
+    message = "Too many logins right now, try again"
+    page = HASHER_BUSY_PAGES.get(request.endpoint)
+    if page and not wants_json():
+        flash(message, "error")
+        resp = Response(render_template(page), mimetype="text/html")
+    else:
+        resp = jsonify(success=False, error=message)
+    resp.status_code = 503
+    resp.headers["Retry-After"] = "2"
+    return resp
+
+# flips accepted orders to 'ready' when their ETA passes
+scheduler = ReadyScheduler(pool, on_ready=lambda *a: orders_changed(*a))
+
+@app.before_request
+def start_background():
+    scheduler.ensure_started()
+    janitor.ensure_started()
+    archive.ensure_started()
+
+@app.before_request
+def begin_request():
+    g.request_stats = metrics.begin()
+    if PROFILE_DIR and request.headers.get("X-Profile") == "1" and profile_lock.acquire(blocking=False):
+        # one profile at a time per worker
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def finish_request(resp):
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            name = "%s-%d-%d.prof" % (request.endpoint or "unmatched", os.getpid(), time.time_ns())
+            profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+            resp.headers["X-Profile"] = name
+        finally:
+            profile_lock.release()
+
+    stats = g.get("request_stats")
+    if stats is not None:
+        elapsed = metrics.finish(stats, request.endpoint, request.method, resp.status_code)
+        resp.headers["Server-Timing"] = "app;dur=%.1f, db;dur=%.1f;desc=\"%d statements\"" % (
+            elapsed * 1000, stats.sql_seconds * 1000, stats.statements)
+    return resp
+
+@before_render_template.connect_via(app)
+def render_started(sender, template, context, **extra):
+    g.setdefault("render_started", []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def render_finished(sender, template, context, **extra):
+    started = g.get("render_started")
+    if started:
+        metrics.rendered(template.name, time.perf_counter() - started.pop())
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop("db", None)
+    if conn is not None:
+        conn.set_trace_callback(None)
+        conn.on_execute = None
+        conn.bound = False
+        conn.close()
+
+@app.route("/health/db")
+def db_health():
+    return jsonify(pool.stats())
+
+@app.route("/health/cache")
+def cache_health():
+    return jsonify(dict(read_cache.stats(), fragments=fragments.stats()))
+
+@app.route("/health/auth")
+def auth_health():
+    return jsonify(
+        revocations=revocations.stats(),
+        passwords=hasher.stats(),
+        sessions=janitor.stats(),
+        store=app.session_interface.stats() if SESSION_BACKEND != "cookie" else None,
+    )
+
+@app.route("/health/writes")
+def writes_health():
+    return jsonify(writer.stats())
+
+@app.route("/health/archive")
+def archive_health():
+    return jsonify(archive.stats())
+
+@app.route("/health/media")
+def media_health():
+    return jsonify(images.stats())
+
+@app.route("/health/sql")
+def sql_health():
+    return jsonify(metrics.stats())
+
+# Prometheus text format, one worker per scrape
+@app.route("/metrics")
+def metrics_text():
+    body = metrics.text({
+        "db_pool": pool.stats(),
+        "writes": writer.stats(),
+        "read_cache": read_cache.stats(),
+        "fragments": fragments.stats(),
+        "passwords": hasher.stats(),
+        "archive": archive.stats(),
+        "sales": sales.stats(),
+    })
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+# hashed names never change content, so browsers may keep them forever;
+# files still under their original upload name get a short lifetime
+@app.route("/media/<path:name>")
+def media(name):
+    hashed = is_hashed(name)
+    resp = send_from_directory(images.root, name, max_age=MEDIA_MAX_AGE if hashed else 300)
+    resp.cache_control.public = True
+    if hashed:
+        resp.cache_control.immutable = True
+    return resp
+
+# url of the smallest copy of an uploaded image at least `width` px wide
+@app.template_global()
+def image_url(name, width=480):
+    return url_for("media", name=images.best(name, width))
+
+# ================= FRAGMENT CACHE =================
+# product cards and order rows are rendered once per distinct content and
+# served from the cache after that; the keys below hold every value the
+# fragment shows, so an edited product or a moved order just misses
+fragments = FragmentCache(app.jinja_env, maxsize=int(os.environ.get("FRAGMENT_CACHE_SIZE", 4096)))
+fragments.precompile()
+
+@app.template_global()
+def product_card(p):
+    img = image_url(p["image"], 480) if p["image"] else None
+    return fragments.render("product_card.html", (tuple(p), img), p=p, img=img)
+
+@app.template_global()
+def owner_order_row(o):
+    key = (o["id"], o["status"], o["token"], o["items"], o["remaining"], o["ready_at"])
+    return fragments.render("owner_order_row.html", key, o=o)
+
+@app.template_global()
+def order_card(o, items):
+    thumbs = [image_url(i["image"], 160) if i["image"] else None for i in items]
+    key = (o["id"], o["status"], o["token"], o["total_price"], o["remaining"], o.get("created_at"),
+           tuple(tuple(i) for i in items), tuple(thumbs))
+    return fragments.render("order_card.html", key, o=o, items=items, thumbs=thumbs)
 
 @app.route("/")
 def home():
@@ -179,6 +639,19 @@ def accept_terms():
 
     return jsonify(success=True, redirect=redirect_url)
 
+# the owner's stall name, looked up only if the template prints it
+class OwnerStallName:
+
+    def __init__(self, owner_id):
+        self.owner_id = owner_id
+
+    def __str__(self):
+        stall = owner_stall(self.owner_id)
+        return stall[1] if stall else ""
+
+    def __bool__(self):
+        return bool(str(self))
+
 @app.context_processor
 def inject_current_user():
 
@@ -186,17 +659,17 @@ def inject_current_user():
     stall_name = None
 
     if user and user.get("role") == "owner":
-        db = get_db()
-        stall = db.execute(
-            "SELECT stall_name FROM stalls WHERE owner_id=?",
-            (user["id"],)
-        ).fetchone()
-
-        if stall:
-            stall_name = stall[0]
+        stall_name = OwnerStallName(user["id"])
 
     return dict(current_user=user, stall_name=stall_name)
 
+# new session id on login / logout; signed-cookie sessions
+# (SESSION_BACKEND=cookie) keep no server state to fix
+def rotate_session():
+    regenerate = getattr(session, "regenerate", None)
+    if regenerate:
+        regenerate()
+
 # ================= LOGIN =================
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -209,39 +682,47 @@ def login():
     if not username or not password:
         return jsonify(success=False, error="Fill all fields")
 
-    db = get_db()
-    user = db.execute(
-        "SELECT * FROM users WHERE TRIM(username) = ?",
-        (username,)
-    ).fetchone()
-    db.close()
+    # not get_db(): the request must not hold a read connection while
+    # writer.run() below takes another, or a burst of logins can drain the pool
+    with pool.connection() as db:
+        user = db.execute(
+            "SELECT * FROM users WHERE username = ?",
+            (username,)
+        ).fetchone()
 
     if not user:
         return jsonify(success=False, error="Invalid Username")
-    if not check_pw(password, user["password"]):
+    matched, new_hash = check_pw(password, user["password"])
+    if not matched:
         return jsonify(success=False, error="Password Not Matched")
+    if new_hash:
+        writer.run(set_password_hash, user["id"], new_hash)
     
-    # ✅ session set
+    # ✅ session set, under a new id (session fixation)
+    rotate_session()
     sid = str(uuid.uuid4())
     session["active_sid"] = sid
     session["user_id"] = user["id"]
-    session.setdefault("sessions", {})[sid] = {
+    sessions = session.setdefault("sessions", {})
+    sessions[sid] = {
         "id": user["id"],
         "user_id": user["id"],
         "username": user["username"],
         "role": user["role"]
     }
-    access_token = create_access_token(user)
+    # one entry per login in this browser; keep the newest few
+    for old_sid in list(sessions)[:-MAX_SESSIONS]:
+        del sessions[old_sid]
+    session.modified = True
     if user["terms_accepted"] == 0:
+        access_token = create_access_token(user)
         return jsonify(success=True, show_terms=True, access_token=access_token)
     refresh_token, sid = create_refresh_token(user["id"])
-    db = get_db()
-    db.execute("""
-    INSERT INTO refresh_tokens (user_id, token, sid, expires_at)
-    VALUES (?, ?, ?, ?)
-    """, (user["id"], refresh_token, sid, (datetime.now(timezone.utc) + timedelta(days=JWT_REFRESH_EXP)).isoformat()))
-    db.commit()
-    db.close()
+    access_token = create_access_token(user, sid)
+    expires_at = (datetime.now(timezone.utc) + timedelta(days=JWT_REFRESH_EXP)).isoformat()
+    dropped = writer.run(save_refresh_token, user["id"], token_digest(refresh_token), sid, expires_at)
+    for old_sid in dropped:
+        revocations.add(old_sid)
 
     # ✅ tell frontend where to go
     redirect_url = "/customer" if user["role"] == "customer" else "/owner"
@@ -256,7 +737,7 @@ def register_owner():
         return render_template("register_owner.html")
 
     username = request.form["username"].strip().lower()
-    password = hash_pw(request.form.get("password"))
+    raw_password = request.form.get("password")
     stall_name = request.form.get("stall_name")
     product_name = request.form.get("product_name", "").strip()
 
@@ -267,22 +748,26 @@ def register_owner():
     except ValueError:
         return render_template("register_owner.html", error="Invalid input")
 
-    if not all([username, password, stall_name, product_name]):
+    if not all([username, raw_password, stall_name, product_name]):
         return render_template("register_owner.html", error="Missing fields")
 
-    if price <= 0 or prep_time <= 0 or availability <= 0 or len(request.form.get("password")) < 8:
+    if price <= 0 or prep_time <= 0 or availability <= 0 or len(raw_password) < 8:
         return render_template("register_owner.html", error="Invalid values")
 
-    image_name = None
+    # only pay for the KDF once the form is known to be valid
+    password = hash_pw(raw_password)
+
+    image_name = width = height = None
     image = request.files.get("product_image")
     if image and image.filename:
-        os.makedirs("static/uploads", exist_ok=True)
-        image_name = image.filename
-        image.save(os.path.join("static/uploads", image_name))
+        try:
+            image_name, width, height = images.save(image)
+        except BadImage as e:
+            return render_template("register_owner.html", error=str(e))
 
     db = get_db()
     try:
-        if db.execute("SELECT id FROM users WHERE TRIM(username)=?", (username,)).fetchone():
+        if db.execute("SELECT id FROM users WHERE username=?", (username,)).fetchone():
             return render_template("register_owner.html", error="Username exists")
         db.execute(
             "INSERT INTO users (username, password, role) VALUES (?, ?, 'owner')",
@@ -290,7 +775,7 @@ def register_owner():
         )
 
         owner_id = db.execute(
-            "SELECT id FROM users WHERE TRIM(username)=?", (username,)
+            "SELECT id FROM users WHERE username=?", (username,)
         ).fetchone()[0]
         db.execute(
             "INSERT INTO stalls (stall_name, owner_id) VALUES (?, ?)",
@@ -303,11 +788,12 @@ def register_owner():
 
         db.execute("""
             INSERT INTO products
-            (stall_id, product_name, price, prep_time, availability, image)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (stall_id, product_name, price, prep_time, availability, image_name))
+            (stall_id, product_name, price, prep_time, availability, image, image_width, image_height)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (stall_id, product_name, price, prep_time, availability, image_name, width, height))
 
         db.commit()
+        read_cache.invalidate("stalls", "owner_stall:%d" % owner_id)
     finally:
         db.close()
 
@@ -340,7 +826,7 @@ def register_customer():
     db = get_db()
     try:
         if db.execute(
-        "SELECT id FROM users WHERE TRIM(username)=?",
+        "SELECT id FROM users WHERE username=?",
         (username,)
         ).fetchone():
             return jsonify(success=False, error="Username exists")
@@ -359,36 +845,36 @@ def register_customer():
 # ================= CUSTOMER =================
 @app.route("/customer")
 def customer():
-    db = get_db()
-    stalls = db.execute("""
-        SELECT id, stall_name
-        FROM stalls
-    """).fetchall()
-    db.close()
-    return render_template("customer.html", stalls=stalls)
+    stalls = stall_list()
+    return render_template("customer.html", stalls=stalls, long_poll=TOKENS_LONG_POLL)
 
 # STALL PRODUCTS
 @app.route("/stall/<int:stall_id>")
 def stall_products(stall_id):
+    cached = not_modified([menu_key(stall_id)], viewer_key())
+    if cached:
+        return cached
 
-    db = get_db()
+    def load():
+        db = get_db()
 
-    # products
-    products = db.execute("""
-        SELECT id, product_name, price, prep_time, availability, image
-        FROM products
-        WHERE stall_id=?
-        ORDER BY id ASC
-    """, (stall_id,)).fetchall()
+        # products
+        products = db.execute("""
+            SELECT id, product_name, price, prep_time, availability, image,
+                   image_width, image_height
+            FROM products
+            WHERE stall_id=?
+            ORDER BY id ASC
+        """, (stall_id,)).fetchall()
 
-    # stall name
-    stall = db.execute("""
-        SELECT stall_name FROM stalls WHERE id=?
-    """, (stall_id,)).fetchone()
+        # stall name
+        stall = db.execute("""
+            SELECT stall_name FROM stalls WHERE id=?
+        """, (stall_id,)).fetchone()
 
-    db.close()
+        return products, stall[0] if stall else "Unknown "
 
-    stall_name = stall[0] if stall else "Unknown "
+    products, stall_name = read_cache.get(menu_key(stall_id), None, load)
 
     return render_template(
         "stall_products.html",
@@ -438,12 +924,14 @@ def add_product():
         flash("Product name is required.")
         return redirect("/owner")
 
-    image_name = None
+    image_name = width = height = None
     image = request.files.get("product_image")
     if image and image.filename:
-        os.makedirs("static/uploads", exist_ok=True)
-        image_name = image.filename
-        image.save(os.path.join("static/uploads", image_name))
+        try:
+            image_name, width, height = images.save(image)
+        except BadImage as e:
+            flash(str(e))
+            return redirect("/owner")
 
     db = get_db()
     try:
@@ -457,16 +945,294 @@ def add_product():
         stall_id = row[0]
         db.execute("""
             INSERT INTO products
-            (stall_id, product_name, price, prep_time, availability, image)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (stall_id, name, price, prep, avail, image_name))
+            (stall_id, product_name, price, prep_time, availability, image, image_width, image_height)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (stall_id, name, price, prep, avail, image_name, width, height))
         db.commit()
+        read_cache.invalidate(menu_key(stall_id))
     finally:
         db.close()
 
     return redirect("/owner")
 
 
+# ================= CHANGE TRACKING =================
+# every order write calls this after commit: bumps the version counters
+# behind the ETags and wakes the live owner feed
+def orders_changed(stall_id, order_ids, customer_ids=()):
+    read_cache.versions.bump("orders:%d" % stall_id)
+    for customer_id in set(customer_ids):
+        read_cache.versions.bump("customer_orders:%d" % customer_id)
+    changes.publish(stall_id, order_ids)
+
+# (id, stall_name) of the owner's stall, or None
+def owner_stall(owner_id):
+    def load():
+        return get_db().execute(
+            "SELECT id, stall_name FROM stalls WHERE owner_id=?",
+            (owner_id,)
+        ).fetchone()
+
+    return read_cache.get("owner_stall:%d" % owner_id, None, load)
+
+# ================= CONDITIONAL GET =================
+def version_tag(counters, *parts):
+    versions = read_cache.versions
+    stamps = [versions.stamp(name) for name in counters]
+    tag = "-".join([versions.epoch] + [str(v) for v, _ in stamps] + [str(p) for p in parts])
+    modified = datetime.fromtimestamp(int(max([m for _, m in stamps] or [0])), timezone.utc)
+    return tag, modified
+
+# ETag / Last-Modified come from version counters only, so a 304 costs no
+# query and no template render. parts are counter names (see
+# orders_changed / menu_key) or plain strings mixed into the tag.
+def not_modified(counters, *parts):
+    # flashed messages are rendered once; never answer 304 over them
+    if session.get("_flashes"):
+        return None
+
+    etag, modified = version_tag(counters, *parts)
+    g.etag = etag
+    g.last_modified = modified
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    else:
+        fresh = bool(request.if_modified_since and modified <= request.if_modified_since)
+    if not fresh:
+        return None
+
+    resp = Response(status=304)
+    resp.set_etag(etag)
+    resp.last_modified = modified
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.vary.add("Cookie")
+    return resp
+
+@app.after_request
+def add_validators(resp):
+    etag = g.pop("etag", None)
+    modified = g.pop("last_modified", None)
+    if etag and resp.status_code == 200:
+        resp.set_etag(etag)
+        resp.last_modified = modified
+        resp.headers["Cache-Control"] = "no-cache"
+        resp.vary.add("Cookie")
+    return resp
+
+def viewer_key():
+    user = current_user()
+    return "u%d" % user["id"] if user else "anon"
+
+# ETA minutes shown on the page change every minute
+def minute():
+    return int(time.time() // 60)
+
+# ================= MENU CACHE =================
+def menu_key(stall_id):
+    return "menu:%d" % stall_id
+
+def stall_list():
+    def load():
+        return get_db().execute("""
+            SELECT id, stall_name
+            FROM stalls
+        """).fetchall()
+
+    return read_cache.get("stalls", None, load)
+
+def invalidate_product_menu(db, pid):
+    row = db.execute("SELECT stall_id FROM products WHERE id=?", (pid,)).fetchone()
+    if row:
+        read_cache.invalidate(menu_key(row[0]))
+
+# ================= PLACE ORDER =================
+# cart: {product_id: quantity}, all from one stall. One write command: one
+# IN (...) lookup, a conditional stock decrement per product, one order row
+# and executemany for the items. Returns (order, None) or (None, error_code).
+def place_order(customer_id, cart):
+    if not cart:
+        return None, "empty_cart"
+    if any(q <= 0 for q in cart.values()):
+        return None, "invalid_quantity"
+
+    try:
+        order, error = writer.run(create_order, customer_id, cart)
+    except OutOfStock:
+        return None, "not_enough_quantity"
+    if order:
+        read_cache.invalidate(menu_key(order["stall_id"]))
+        orders_changed(order["stall_id"], [order["id"]], [customer_id])
+    return order, error
+
+# ================= WRITE COMMANDS =================
+# Run through writer.run(): inside a write transaction (or a savepoint of a
+# group commit) that the writer commits; raising undoes the command.
+# Arguments and results must pickle (WRITE_MODE=socket).
+
+@writer.command
+def create_order(db, customer_id, cart):
+    product_ids = list(cart)
+    products = db.execute("""
+        SELECT id, stall_id, price
+        FROM products
+        WHERE id IN (%s)
+    """ % ",".join("?" * len(product_ids)), product_ids).fetchall()
+
+    if len(products) != len(product_ids):
+        return None, "product_not_found"
+
+    stall_ids = {p["stall_id"] for p in products}
+    if len(stall_ids) != 1:
+        return None, "mixed_stalls"
+    stall_id = stall_ids.pop()
+
+    # OutOfStock undoes the whole command
+    reserve(db, cart)
+
+    token, day = next_token(db, stall_id)
+    total = sum(p["price"] * cart[p["id"]] for p in products)
+
+    order_id = db.execute("""
+        INSERT INTO orders (customer_id, stall_id, price, token, token_day)
+        VALUES (?, ?, ?, ?, ?)
+    """, (customer_id, stall_id, total, token, day)).lastrowid
+
+    db.executemany("""
+        INSERT INTO order_items (order_id, product_id, quantity)
+        VALUES (?, ?, ?)
+    """, [(order_id, pid, cart[pid]) for pid in product_ids])
+    refresh_order_summaries(db, [order_id])
+
+    return {"id": order_id, "stall_id": stall_id, "token": token, "price": total}, None
+
+# status change by the stall's owner; None if the order isn't theirs or is
+# cancelled, else what changed
+@writer.command
+def set_order_status(db, owner_id, order_id, status, now_iso):
+    order = db.execute("""
+        SELECT o.status, o.stall_id, o.customer_id
+        FROM orders o JOIN stalls s ON s.id = o.stall_id
+        WHERE o.id=? AND s.owner_id=?
+    """, (order_id, owner_id)).fetchone()
+
+    if not order or order["status"] == "cancelled":
+        return None
+
+    result = {
+        "from": order["status"],
+        "to": None,
+        "stall_id": order["stall_id"],
+        "customer_id": order["customer_id"],
+        "prep_time": None,
+    }
+
+    # 1️⃣ PENDING → ACCEPTED
+    if order["status"] == "pending" and status == "accepted":
+        # prep time is fixed at accept time so the scheduler never needs the join
+        result["prep_time"] = db.execute(
+            """
+            UPDATE orders
+            SET status='accepted',
+                accepted_at=?,
+                prep_time=COALESCE(prep_total, 0)
+            WHERE id=?
+            RETURNING prep_time
+            """,
+            (now_iso, order_id)
+        ).fetchone()[0]
+        result["to"] = status
+
+    # 2️⃣ PENDING → REJECTED
+    elif order["status"] == "pending" and status == "rejected":
+        db.execute(
+            """
+            UPDATE orders
+            SET status='rejected'
+            WHERE id=?
+            """,
+            (order_id,)
+        )
+        result["to"] = status
+
+    # 3️⃣ ACCEPTED → READY
+    elif order["status"] == "accepted" and status == "ready":
+        db.execute(
+            """
+            UPDATE orders
+            SET status='ready'
+            WHERE id=?
+            """,
+            (order_id,)
+        )
+        result["to"] = status
+
+    return result
+
+# the status flip decides who cancels: a double submit (or the owner
+# accepting at the same moment) can't put the stock back twice
+@writer.command
+def cancel_pending_order(db, order_id, customer_id):
+    order = db.execute("""
+        UPDATE orders
+        SET status='cancelled'
+        WHERE id=? AND customer_id=? AND status='pending'
+        RETURNING stall_id
+    """, (order_id, customer_id)).fetchone()
+    if not order:
+        return None
+    items = db.execute("""
+        SELECT product_id, quantity
+        FROM order_items
+        WHERE order_id=?
+    """, (order_id,)).fetchall()
+    release(db, items)
+    return order["stall_id"]
+
+# soft-deletes the owner's finished orders; [(order_id, stall_id)]
+@writer.command
+def clear_finished_orders(db, owner_id):
+    return [tuple(row) for row in db.execute("""
+    UPDATE  orders SET is_deleted = 1
+    WHERE stall_id IN (
+        SELECT s.id
+        FROM stalls s
+        WHERE s.owner_id = ?
+    )
+    AND status NOT IN ('pending', 'accepted')
+    AND is_deleted = 0
+    RETURNING id, stall_id
+""", (owner_id,)).fetchall()]
+
+# new login session; returns the sids dropped by the per-user cap
+@writer.command
+def save_refresh_token(db, user_id, digest, sid, expires_at):
+    db.execute("""
+    INSERT INTO refresh_tokens (user_id, token_hash, sid, expires_at)
+    VALUES (?, ?, ?, ?)
+    """, (user_id, digest, sid, expires_at))
+    # oldest devices are logged out once a user is over the cap
+    return cap_sessions(db, user_id, MAX_SESSIONS)
+
+@writer.command
+def set_password_hash(db, user_id, hashed):
+    db.execute("UPDATE users SET password = ? WHERE id = ?", (hashed, user_id))
+
+# checkout body: JSON {"items": [{"product_id": 1, "quantity": 2}, ...]}
+# or form fields product_id / quantity repeated once per item
+def read_cart():
+    data = request.get_json(silent=True)
+    if data is not None:
+        pairs = [(i.get("product_id"), i.get("quantity", 1)) for i in data.get("items", [])]
+    else:
+        pairs = zip(request.form.getlist("product_id"), request.form.getlist("quantity"))
+
+    cart = {}
+    for product_id, quantity in pairs:
+        product_id, quantity = int(product_id), int(quantity)
+        cart[product_id] = cart.get(product_id, 0) + quantity
+    return cart
+
 # ================= GENERATE TOKEN =================
 @app.route("/generate_token", methods=["POST"])
 def generate_token():
@@ -474,65 +1240,53 @@ def generate_token():
     if not user or user["role"] != "customer":
         return jsonify({"error": "login_required"})
 
-    product_id = request.form.get("product_id")
-    quantity = int(request.form.get("quantity", 1))
-
-    db = get_db()
     try:
-        db.execute("BEGIN")
-
-        product = db.execute("""
-            SELECT id, stall_id, price, availability
-            FROM products
-            WHERE id=?
-        """, (product_id,)).fetchone()
-
-        if not product:
-            db.rollback()
-            return jsonify({"error": "product_not_found"})
+        product_id = int(request.form.get("product_id"))
+    except (TypeError, ValueError):
+        return jsonify({"error": "product_not_found"})
+    try:
+        quantity = int(request.form.get("quantity", 1))
+    except (TypeError, ValueError):
+        return jsonify({"error": "invalid_quantity"})
+    if quantity <= 0:
+        return jsonify({"error": "invalid_quantity"})
 
-        if product["availability"] < quantity:
-            db.rollback()
-            return jsonify({"error": "not_enough_quantity"})
+    try:
+        order, error = place_order(user["id"], {product_id: quantity})
+        if error:
+            return jsonify({"error": error})
 
-        token = db.execute("""
-            SELECT COALESCE(MAX(token),0)+1
-            FROM orders
-            WHERE stall_id=?
-        """, (product["stall_id"],)).fetchone()[0]
+        flash(f"Token no. {order['token']}", "success")
+        return jsonify(success=True, token=order["token"])
 
-        db.execute("""
-            INSERT INTO orders (customer_id, stall_id, price, token)
-            VALUES (?, ?, ?, ?)
-        """, (user["id"], product["stall_id"], product["price"] * quantity, token))
+    except Exception:
+        flash("Something went wrong. Try again.", "error")
+        return jsonify(success=False)
 
-        order_id = db.execute(
-            "SELECT last_insert_rowid()"
-        ).fetchone()[0]
+# ================= CHECKOUT =================
+@app.route("/checkout", methods=["POST"])
+def checkout():
+    user = current_user()
+    if not user or user["role"] != "customer":
+        return jsonify({"error": "login_required"})
 
-        db.execute("""
-            INSERT INTO order_items (order_id, product_id, quantity)
-            VALUES (?, ?, ?)
-        """, (order_id, product_id, quantity))
+    try:
+        cart = read_cart()
+    except (TypeError, ValueError, AttributeError):
+        return jsonify({"error": "invalid_cart"})
 
-        db.execute("""
-            UPDATE products
-            SET availability = availability - ?
-            WHERE id=? AND availability >= ?
-        """, (quantity, product_id, quantity))
+    try:
+        order, error = place_order(user["id"], cart)
+        if error:
+            return jsonify({"error": error})
 
-        db.commit()
-        flash(f"Token no. {token}", "success")
-        return jsonify(success=True, token=token)
+        flash(f"Token no. {order['token']}", "success")
+        return jsonify(success=True, token=order["token"], order_id=order["id"], total=order["price"])
 
     except Exception:
-        db.rollback()
         flash("Something went wrong. Try again.", "error")
         return jsonify(success=False)
 
-    finally:
-        db.close()
-
 # ================= OWNER ORDERS =================
 @app.route("/owner_orders")
 def owner_orders():
@@ -540,54 +1294,27 @@ def owner_orders():
     if not user or user["role"] != "owner":
         return redirect("/login")
 
+    before = request.args.get("before", type=int)
+
     db = get_db()
     try:
-        orders = db.execute("""
-    SELECT
-        o.id,
-        o.token,
-        o.status,
-        o.accepted_at,
-        SUM(oi.quantity * p.price) AS total_price,
-        GROUP_CONCAT(p.product_name || ' x ' || oi.quantity) AS items,
-        SUM(p.prep_time * oi.quantity) AS prep_time
-    FROM orders o
-LEFT JOIN order_items oi ON oi.order_id = o.id
-LEFT JOIN products p ON p.id = oi.product_id
-    JOIN stalls s ON o.stall_id = s.id
-    WHERE s.owner_id = ?
-    AND o.is_deleted = 0
-    AND o.status IN ('pending','accepted','rejected','ready','cancelled')
-GROUP BY
-        o.id
-ORDER BY
-    CASE o.status
-        WHEN 'pending' THEN 1
-        WHEN 'accepted' THEN 1
-        WHEN 'ready' THEN 2
-        WHEN 'cancelled' THEN 3
-        WHEN 'rejected' THEN 3
-    END,
-    o.id DESC
-        """, (current_user()["id"],)).fetchall()
+        orders = owner_order_rows(db, user["id"], before=before, limit=ORDERS_PAGE_SIZE)
 
         orders_with_eta = []
-        orders_with_eta = apply_eta_queue(orders)
-        order_items = {}
-
-        for o in orders_with_eta:
-            items = db.execute("""
-            SELECT p.product_name, oi.quantity, p.image
-            FROM order_items oi
-            JOIN products p ON oi.product_id = p.id
-            WHERE oi.order_id=?
-            """, (o["id"],)).fetchall()
-            order_items[o["id"]] = items
+        orders_with_eta = scheduler.annotate(orders, db)
+        order_items = load_order_items(db, [o["id"] for o in orders_with_eta])
 
     finally:
         db.close()
 
-    return render_template("owner_orders.html", orders=orders_with_eta, order_items=order_items)
+    return render_template(
+        "owner_orders.html",
+        orders=orders_with_eta,
+        order_items=order_items,
+        before=before,
+        next_before=next_cursor(orders, ORDERS_PAGE_SIZE),
+        stream=ORDER_STREAM
+    )
 
 
 # AUTO REFRESH
@@ -596,61 +1323,186 @@ def owner_orders_partial():
     user = current_user()
     if not user or user["role"] != "owner":
         return ""
+
+    stall = owner_stall(user["id"])
+    if stall:
+        cached = not_modified(["orders:%d" % stall[0]], viewer_key(), minute())
+        if cached:
+            return cached
+
     db = get_db()
 
-    orders = db.execute("""
-       SELECT
-        o.id,
-        o.token,
-        o.status,
-        o.accepted_at,
-        SUM(oi.quantity * p.price) AS total_price,
-        GROUP_CONCAT(p.product_name || ' x ' || oi.quantity) AS items,
-        SUM(p.prep_time * oi.quantity) AS prep_time
-    FROM orders o
-LEFT JOIN order_items oi ON oi.order_id = o.id
-LEFT JOIN products p ON p.id = oi.product_id
-    JOIN stalls s ON o.stall_id = s.id
-    WHERE s.owner_id = ?
-    AND o.is_deleted = 0
-    AND o.status IN ('pending','accepted','rejected','ready','cancelled')
-GROUP BY
-        o.id
-ORDER BY
-    CASE o.status
-        WHEN 'pending' THEN 1
-        WHEN 'accepted' THEN 1
-        WHEN 'ready' THEN 2
-        WHEN 'cancelled' THEN 3
-        WHEN 'rejected' THEN 3
-    END,
-    o.id DESC
-    """, (user["id"],)).fetchall()
+    orders = owner_order_rows(db, user["id"], limit=ORDERS_PAGE_SIZE)
     orders_with_eta = []
-    orders_with_eta = apply_eta_queue(orders)
+    orders_with_eta = scheduler.annotate(orders, db)
     db.close()
     return render_template(
         "owner_orders_partial.html",
         orders=orders_with_eta
     )
 
+# LIVE ORDER FEED (Server-Sent Events)
+# ((owner_id, stall_id), None) for the logged-in owner's order stream, or
+# (None, http status). Also used by the async server (asgi.py).
+def order_stream_owner():
+    user = current_user()
+    if not user or user["role"] != "owner":
+        return None, 403
+
+    # a short checkout: nothing may hold a pooled connection for the life
+    # of the stream
+    with pool.connection() as db:
+        stall = db.execute(
+            "SELECT id FROM stalls WHERE owner_id=?",
+            (user["id"],)
+        ).fetchone()
+    if not stall:
+        return None, 404
+    return (user["id"], stall[0]), None
+
+def stream_since(header):
+    try:
+        return int(header or "")
+    except ValueError:
+        return changes.seq
+
+# (rows, removed ids) for some changed orders of the owner's stall: rows
+# annotated with their ETA; accepted orders share one ETA queue, so they
+# are re-sent too. Also used by the JSON API.
+def owner_changed_orders(db, owner_id, stall_id, order_ids):
+    accepted = db.execute("""
+        SELECT id FROM orders
+        WHERE stall_id=? AND status='accepted' AND is_deleted=0
+    """, (stall_id,)).fetchall()
+    wanted = set(order_ids) | {r[0] for r in accepted}
+    rows = owner_order_rows(db, owner_id, sorted(wanted))
+    rows = scheduler.annotate(rows, db)
+
+    found = {o["id"] for o in rows}
+    return rows, [i for i in order_ids if i not in found]
+
+# payload of one "orders" event: the changed rows re-rendered, plus ids
+# that are gone from the owner's list
+def owner_changed_rows(db, owner_id, stall_id, order_ids):
+    rows, removed = owner_changed_orders(db, owner_id, stall_id, order_ids)
+    return {
+        "rows": [
+            {"id": o["id"], "status": o["status"], "html": str(owner_order_row(o))}
+            for o in rows
+        ],
+        "removed": removed,
+    }
+
+@app.route("/owner_orders/stream")
+def owner_orders_stream():
+    target, status = order_stream_owner()
+    if not target:
+        return "", status
+
+    owner_id, stall_id = target
+    since = stream_since(request.headers.get("Last-Event-ID"))
+
+    def events():
+        last = since
+        yield "retry: 3000\n\n"
+        while True:
+            seq, order_ids = changes.wait(stall_id, last, timeout=SSE_KEEPALIVE)
+            last = seq
+            if order_ids is None:
+                yield "id: %d\nevent: reset\ndata: {}\n\n" % seq
+            elif order_ids:
+                with pool.connection() as db:
+                    data = json.dumps(owner_changed_rows(db, owner_id, stall_id, order_ids))
+                yield "id: %d\nevent: orders\ndata: %s\n\n" % (seq, data)
+            else:
+                yield ": ping\n\n"
+
+    return Response(events(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
 # TOKEN COUNTER 
 @app.route("/current_token")
 def current_token():
+    stall_id = request.args.get("stall_id", type=int)
+    if not stall_id:
+        return jsonify({"token": 0})
+
+    cached = not_modified(["orders:%d" % stall_id])
+    if cached:
+        return cached
+
     db = get_db()
     try:
-        stall_id = request.args.get("stall_id")
-        if not stall_id:
-            return jsonify({"token": 0})
-
         row = db.execute(
-            "SELECT COALESCE(MAX(token),0) FROM orders WHERE stall_id=?",
+            "SELECT last_token, token_day FROM stall_sequences WHERE stall_id=?",
             (stall_id,)
         ).fetchone()
-        return jsonify({"token": row[0]})
+        if not row or row["token_day"] != token_day():
+            return jsonify({"token": 0})
+        return jsonify({"token": row["last_token"]})
     finally:
         db.close()
 
+# every stall's counter in one request; replaces one /current_token call
+# per stall card. ?stall_ids=1,2,3 or ?stall_ids=all (the default).
+# Long-poll: pass back the "version" of the last answer plus wait=<seconds>
+# and the request blocks until one of the watched counters moves.
+TOKENS_MAX_WAIT = 25   # seconds
+TOKENS_MAX_STALLS = 200
+
+# (stall ids, version counters, stalls to wake on or None for any) for a
+# ?stall_ids= value; raises ValueError on a malformed list
+def token_counters(raw):
+    if raw == "all":
+        stall_ids = [s[0] for s in stall_list()]
+        counters = ["stalls"]
+    else:
+        stall_ids = sorted({int(i) for i in raw.split(",") if i.strip()})[:TOKENS_MAX_STALLS]
+        counters = []
+    counters += ["orders:%d" % i for i in stall_ids]
+    return stall_ids, counters, None if raw == "all" else stall_ids
+
+@app.route("/current_tokens")
+def current_tokens():
+    try:
+        stall_ids, counters, watched = token_counters(request.args.get("stall_ids", "all"))
+    except ValueError:
+        return jsonify({"error": "invalid_stall_ids"}), 400
+
+    wait = min(request.args.get("wait", 0, type=float), TOKENS_MAX_WAIT)
+    version = request.args.get("version")
+    if wait > 0 and version:
+        # nothing is read from the database while we wait
+        deadline = time.monotonic() + wait
+        while version_tag(counters)[0] == version:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            # short slices so writes from other workers (shared versions) are seen too
+            changes.wait_any(watched, changes.seq, min(left, 1.0))
+    else:
+        cached = not_modified(counters)
+        if cached:
+            return cached
+
+    version = version_tag(counters)[0]
+    tokens = {str(i): 0 for i in stall_ids}
+    if stall_ids:
+        db = get_db()
+        rows = db.execute("""
+            SELECT stall_id, last_token, token_day
+            FROM stall_sequences
+            WHERE stall_id IN (%s)
+        """ % ",".join("?" * len(stall_ids)), stall_ids).fetchall()
+        day = token_day()
+        for row in rows:
+            if row["token_day"] == day:
+                tokens[str(row["stall_id"])] = row["last_token"]
+
+    return jsonify({"tokens": tokens, "version": version})
+
 # ================= UPDATE ORDER STATUS =================
 @app.route("/update_order_status/<int:order_id>/<status>")
 def update_order_status(order_id, status):
@@ -661,56 +1513,48 @@ def update_order_status(order_id, status):
     if status not in ("accepted", "rejected", "ready"):
         return redirect("/owner_orders")
 
-    db = get_db()
-    order = db.execute(
-        "SELECT status FROM orders WHERE id=?",
-        (order_id,)
-    ).fetchone()
+    # 🔥 time yahin lo (ONLY HERE)
+    now_iso = datetime.now(timezone.utc).isoformat()
 
-    if not order or order["status"] == "cancelled":
-        db.close()
+    change = writer.run(set_order_status, user["id"], order_id, status, now_iso)
+    if not change:
         return redirect("/owner_orders")
 
-    # 🔥 time yahin lo (ONLY HERE)
-    now_iso = datetime.now(timezone.utc).isoformat()
+    if change["to"] == "accepted":
+        scheduler.accepted(change["stall_id"], order_id, now_iso, change["prep_time"])
+    elif change["to"] == "ready":
+        scheduler.discard(order_id)
 
-    # 1️⃣ PENDING → ACCEPTED
-    if order["status"] == "pending" and status == "accepted":
-        db.execute(
-            """
-            UPDATE orders
-            SET status='accepted',
-                accepted_at=?
-            WHERE id=?
-            """,
-            (now_iso, order_id)
-        )
+    orders_changed(change["stall_id"], [order_id], [change["customer_id"]])
+    return redirect("/owner_orders")
 
-    # 2️⃣ PENDING → REJECTED
-    elif order["status"] == "pending" and status == "rejected":
-        db.execute(
-            """
-            UPDATE orders
-            SET status='rejected'
-            WHERE id=?
-            """,
-            (order_id,)
-        )
+# ================= SALES ANALYTICS =================
+def analytics_days():
+    return min(max(request.args.get("days", 7, type=int), 1), 90)
 
-    # 3️⃣ ACCEPTED → READY
-    elif order["status"] == "accepted" and status == "ready":
-        db.execute(
-            """
-            UPDATE orders
-            SET status='ready'
-            WHERE id=?
-            """,
-            (order_id,)
-        )
+@app.route("/owner/analytics")
+def owner_analytics():
+    user = current_user()
+    if not user or user["role"] != "owner":
+        return redirect("/login")
+    stall = owner_stall(user["id"])
+    if not stall:
+        return redirect("/owner")
 
-    db.commit()
-    db.close()
-    return redirect("/owner_orders")
+    report = sales.report(get_db(), stall[0], analytics_days())
+    return render_template("owner_analytics.html", report=report)
+
+@app.route("/api/owner/analytics")
+@jwt_required
+def api_owner_analytics():
+    user = request.jwt_user
+    if user["role"] != "owner":
+        return jsonify(error="Forbidden"), 403
+    stall = owner_stall(user["user_id"])
+    if not stall:
+        return jsonify(error="Stall not found"), 404
+
+    return jsonify(sales.report(get_db(), stall[0], analytics_days()))
 
 # ORDER HISTORY
 @app.route("/order_history")
@@ -719,61 +1563,29 @@ def order_history():
     if not user or user["role"] != "customer":
         return redirect("/login")
 
+    before = request.args.get("before", type=int)
+
+    cached = not_modified(["customer_orders:%d" % user["id"]], viewer_key(), minute())
+    if cached:
+        return cached
+
     db = get_db()    
-    orders = db.execute("""
-        SELECT 
-        o.id,
-        o.token,
-        o.status,
-        COALESCE(SUM(oi.quantity * p.price), o.price) AS total_price,
-        o.accepted_at,
-        GROUP_CONCAT(
-        COALESCE(p.product_name, '[Deleted Product]') || ' x' || oi.quantity
-        ) AS item,
-        SUM(p.prep_time * oi.quantity) AS prep_time
-    FROM orders o
-    LEFT JOIN order_items oi ON oi.order_id = o.id
-    LEFT JOIN products p ON p.id = oi.product_id
-    WHERE o.customer_id = ?
-    GROUP BY
-        o.id
-ORDER BY
-    CASE o.status
-        WHEN 'accepted' THEN 1
-        WHEN 'ready' THEN 1
-        WHEN 'pending' THEN 2
-        WHEN 'cancelled' THEN 3
-        WHEN 'rejected' THEN 3
-    END,
-    o.id DESC
-    """, (user["id"],)).fetchall()
+    orders = customer_order_rows(db, user["id"], before=before, limit=ORDERS_PAGE_SIZE)
     orders_with_eta = []
 
 # 👉 accepted order ke hisaab se sort
-    orders_with_eta = apply_eta_queue(orders)
-
-    order_items = {}
-
-    for o in orders_with_eta:
-        items = db.execute("""
-        SELECT 
-        COALESCE(p.product_name, '[Deleted Product]') AS product_name,
-        oi.quantity,
-        p.image
-        FROM order_items oi
-        LEFT JOIN products p ON oi.product_id = p.id
-        WHERE oi.order_id=?
-        """, (o["id"],)).fetchall()
-
-
-        order_items[o["id"]] = items
+    orders_with_eta = scheduler.annotate(orders, db)
 
+    order_items = load_order_items(db, [o["id"] for o in orders_with_eta])
+    # orders with no hot items may have been moved to the archive
+    order_items.update(archive.items([i for i, rows in order_items.items() if not rows]))
 
     db.close()
     return render_template(
         "your_orders.html",
         orders=orders_with_eta,
-        order_items=order_items
+        order_items=order_items,
+        next_before=next_cursor(orders, ORDERS_PAGE_SIZE)
     )
 
 
@@ -812,9 +1624,16 @@ def update_product(pid):
         SET product_name=?, price=?, prep_time=?, availability=?
         WHERE id=?
     """, (product_name, price, prep_time, availability, pid))
+    # order lists show the product's current name and price
+    order_ids, customer_ids = orders_with_product(db, pid)
+    refresh_order_summaries(db, order_ids)
 
     db.commit()
+    invalidate_product_menu(db, pid)
+    stall = db.execute("SELECT stall_id FROM products WHERE id=?", (pid,)).fetchone()
     db.close()
+    if stall and order_ids:
+        orders_changed(stall[0], order_ids, customer_ids)
 
     return redirect("/owner")
 
@@ -827,11 +1646,18 @@ def delete_product(pid):
         return redirect("/login")
 
     db = get_db()
+    product = db.execute("SELECT stall_id FROM products WHERE id=?", (pid,)).fetchone()
+    order_ids, customer_ids = orders_with_product(db, pid)
     db.execute("DELETE FROM order_items WHERE product_id=?", (pid,))
     db.execute("DELETE FROM products WHERE id=?", (pid,))
+    refresh_order_summaries(db, order_ids)
 
     db.commit()
+    if product:
+        read_cache.invalidate(menu_key(product["stall_id"]))
     db.close()
+    if product and order_ids:
+        orders_changed(product["stall_id"], order_ids, customer_ids)
 
     return redirect("/owner")
 
@@ -842,38 +1668,10 @@ def cancel_order(order_id):
     if not user or user["role"] != "customer":
         return redirect("/login")
 
-    db = get_db()
-    try:
-        order = db.execute("""
-            SELECT status FROM orders
-            WHERE id=? AND customer_id=? AND status='pending' 
-        """, (order_id, current_user()["id"])).fetchone()
-
-        if not order or order[0] != "pending":
-            return redirect("/order_history")
-
-        items = db.execute("""
-            SELECT product_id, quantity
-            FROM order_items
-            WHERE order_id=?
-        """, (order_id,)).fetchall()
-
-        for pid, qty in items:
-            db.execute("""
-                UPDATE products
-                SET availability = availability + ?
-                WHERE id=?
-            """, (qty, pid))
-
-        db.execute("""
-            UPDATE orders
-            SET status='cancelled'
-            WHERE id=?
-        """, (order_id,))
-
-        db.commit()
-    finally:
-        db.close()
+    stall_id = writer.run(cancel_pending_order, order_id, user["id"])
+    if stall_id:
+        read_cache.invalidate(menu_key(stall_id))
+        orders_changed(stall_id, [order_id], [user["id"]])
 
     return redirect("/order_history")
 
@@ -893,30 +1691,26 @@ def refresh():
         return jsonify({"error": "Invalid refresh token"}), 401
 
     user_id = data.get("user_id")
-    if not user_id:
+    sid = data.get("sid")
+    if not user_id or not sid:
         return jsonify({"error": "Invalid payload"}), 401
 
-    db = get_db()
-
-    # 2️⃣ Check token exists in DB (revoked / logout protection)
-    row = db.execute(
-        "SELECT 1 FROM refresh_tokens WHERE token=? AND user_id=?",
-        (token, user_id)
-    ).fetchone()
-
-    if not row:
-        db.close()
+    # 2️⃣ Logged out in this worker (or synced from another): no DB trip
+    if revocations.is_revoked(sid):
         return jsonify({"error": "Token revoked"}), 401
 
-    # 3️⃣ 🔥 FETCH USER FROM DB (IMPORTANT PART)
-    user = db.execute(
-        "SELECT id, username, role FROM users WHERE id=?",
-        (user_id,)
-    ).fetchone()
+    # 3️⃣ 🔥 Token still live + user, one indexed lookup on the digest
+    db = get_db()
+    user = db.execute("""
+        SELECT u.id, u.username, u.role
+        FROM refresh_tokens rt
+        JOIN users u ON u.id = rt.user_id
+        WHERE rt.token_hash = ? AND rt.user_id = ? AND rt.revoked_at IS NULL
+    """, (token_digest(token), user_id)).fetchone()
     db.close()
 
     if not user:
-        return jsonify({"error": "User not found"}), 401
+        return jsonify({"error": "Token revoked"}), 401
 
     user_dict = {
         "id": user["id"],
@@ -925,7 +1719,7 @@ def refresh():
     }
 
     # 4️⃣ Create new access token with FULL INFO
-    new_access_token = create_access_token(user_dict)
+    new_access_token = create_access_token(user_dict, sid)
 
     return jsonify({"access_token": new_access_token})
 
@@ -935,23 +1729,14 @@ def clear_orders():
     if not user or user["role"] != "owner":
         return jsonify(success=False, error="Forbidden"), 403
 
-    db = get_db()
-
     # 🔥 OWNER ke stall ke orders clear karo
+    cleared = writer.run(clear_finished_orders, user["id"])
 
-    db.execute("""
-    UPDATE  orders SET is_deleted = 1
-    WHERE stall_id IN (
-        SELECT s.id
-        FROM stalls s
-        WHERE s.owner_id = ?
-    )
-    AND status NOT IN ('pending', 'accepted')
-    AND is_deleted = 0
-""", (user["id"],))
-
-    db.commit()
-    db.close()
+    by_stall = {}
+    for order_id, stall_id in cleared:
+        by_stall.setdefault(stall_id, []).append(order_id)
+    for stall_id, order_ids in by_stall.items():
+        orders_changed(stall_id, order_ids)
     return jsonify(success=True)
 
 
@@ -961,15 +1746,170 @@ def logout():
 
     if token:
         db = get_db()
-        db.execute("DELETE FROM refresh_tokens WHERE token=?", (token,))
+        revoked = db.execute("""
+            UPDATE refresh_tokens SET revoked_at = ?
+            WHERE token_hash = ? AND revoked_at IS NULL
+            RETURNING sid
+        """, (utcnow(), token_digest(token))).fetchall()
         db.commit()
         db.close()
+        for (sid,) in revoked:
+            revocations.add(sid)
 
     resp = redirect("/login")
     resp.delete_cookie("refresh_token")
 
     session.clear()
+    rotate_session()
     return resp
 
+# ================= JSON API =================
+# Bearer-token API for apps and scripts. Every list answers
+#   {"cursor": n, "full": bool, "<rows>": [...], "removed": [ids]}
+# Pass the cursor back as ?since=n to get only what changed after it;
+# "full" means the rows are a whole snapshot (first call, or a cursor too
+# old to diff against) and the client should replace its copy. The cursor
+# is read before the rows, so a write racing the request is sent again
+# next time rather than missed.
+API_DELTA_LIMIT = 500    # more changed rows than this: send a snapshot
+
+def api_since():
+    since = request.args.get("since", type=int)
+    return since if since is not None and since >= 0 else None
+
+# (cursor, full) for a request's ?since=
+def delta_window(db, since):
+    cursor, pruned = db.execute("SELECT seq, pruned_seq FROM change_cursor WHERE id = 1").fetchone()
+    full = since is None or since < pruned or since > cursor
+    return cursor, full
+
+def deleted_since(db, kind, stall_id, since):
+    return [r[0] for r in db.execute("""
+        SELECT row_id FROM deleted_rows
+        WHERE stall_id = ? AND change_seq > ? AND kind = ?
+    """, (stall_id, since, kind))]
+
+def api_product(p):
+    return {
+        "id": p["id"],
+        "name": p["product_name"],
+        "price": p["price"],
+        "prep_time": p["prep_time"],
+        "availability": p["availability"],
+        "image": image_url(p["image"], 480) if p["image"] else None,
+        "image_width": p["image_width"],
+        "image_height": p["image_height"],
+    }
+
+@app.after_request
+def compress_api(resp):
+    if request.path.startswith("/api/"):
+        compress_response(resp, request.accept_encodings)
+    return resp
+
+@app.route("/api/stalls/<int:stall_id>/menu")
+@jwt_required
+def api_menu(stall_id):
+    since = api_since()
+    db = get_db()
+    stall = db.execute("SELECT id, stall_name FROM stalls WHERE id=?", (stall_id,)).fetchone()
+    if not stall:
+        return jsonify(error="Stall not found"), 404
+
+    cursor, full = delta_window(db, since)
+    sql = """
+        SELECT id, product_name, price, prep_time, availability, image,
+               image_width, image_height
+        FROM products
+        WHERE stall_id=?
+    """
+    if full:
+        products = db.execute(sql + " ORDER BY id", (stall_id,)).fetchall()
+        removed = []
+    else:
+        products = db.execute(sql + " AND change_seq > ? ORDER BY id", (stall_id, since)).fetchall()
+        removed = deleted_since(db, "product", stall_id, since)
+
+    return jsonify(
+        cursor=cursor,
+        full=full,
+        stall={"id": stall["id"], "name": stall["stall_name"]},
+        products=[api_product(p) for p in products],
+        removed=removed,
+    )
+
+@app.route("/api/owner/orders")
+@jwt_required
+def api_owner_orders():
+    user = request.jwt_user
+    if user["role"] != "owner":
+        return jsonify(error="Forbidden"), 403
+    stall = owner_stall(user["user_id"])
+    if not stall:
+        return jsonify(error="Stall not found"), 404
+
+    since = api_since()
+    db = get_db()
+    cursor, full = delta_window(db, since)
+    if not full:
+        changed = [r[0] for r in db.execute(
+            "SELECT id FROM orders WHERE stall_id = ? AND change_seq > ?",
+            (stall[0], since)
+        )]
+        full = len(changed) > API_DELTA_LIMIT
+
+    if full:
+        orders = scheduler.annotate(owner_order_rows(db, user["user_id"], limit=ORDERS_PAGE_SIZE), db)
+        removed = []
+    elif changed:
+        # soft-deleted (cleared) orders come back as removed
+        orders, removed = owner_changed_orders(db, user["user_id"], stall[0], changed)
+        removed += deleted_since(db, "order", stall[0], since)
+    else:
+        orders, removed = [], deleted_since(db, "order", stall[0], since)
+
+    return jsonify(cursor=cursor, full=full, orders=orders, removed=removed)
+
+# archived orders keep their last state, so this list only grows / updates;
+# older history stays on /order_history
+@app.route("/api/customer/orders")
+@jwt_required
+def api_customer_orders():
+    user = request.jwt_user
+    if user["role"] != "customer":
+        return jsonify(error="Forbidden"), 403
+
+    since = api_since()
+    db = get_db()
+    cursor, full = delta_window(db, since)
+    if not full:
+        changed = {r[0] for r in db.execute(
+            "SELECT id FROM orders WHERE customer_id = ? AND change_seq > ?",
+            (user["user_id"], since)
+        )}
+        # an accepted order's ETA moves when anything in its stall's queue
+        # changes, so those are re-sent when their stall saw a change
+        accepted = db.execute(
+            "SELECT id, stall_id FROM orders WHERE customer_id = ? AND status = 'accepted'",
+            (user["user_id"],)
+        ).fetchall()
+        stalls = sorted({r["stall_id"] for r in accepted})
+        if stalls and db.execute(
+            "SELECT 1 FROM orders WHERE stall_id IN (%s) AND change_seq > ? LIMIT 1" % ",".join("?" * len(stalls)),
+            stalls + [since]
+        ).fetchone():
+            changed.update(r["id"] for r in accepted)
+        full = len(changed) > API_DELTA_LIMIT
+
+    if full:
+        orders = customer_order_rows(db, user["user_id"], limit=ORDERS_PAGE_SIZE)
+    elif changed:
+        orders = customer_order_rows(db, user["user_id"], order_ids=sorted(changed))
+    else:
+        orders = []
+    orders = scheduler.annotate(orders, db)
+
+    return jsonify(cursor=cursor, full=full, orders=orders, removed=[])
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
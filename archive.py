@@ -0,0 +1,259 @@
+import sqlite3, threading, time, os
+from datetime import datetime, timedelta, timezone
+
+FINISHED = ("ready", "rejected", "cancelled")
+
+ORDER_COLUMNS = (
+    "id, customer_id, stall_id, price, token, token_day, status, created_at, "
+    "accepted_at, prep_time, is_deleted, total_price, items_summary, prep_total, "
+    "customer_rank, finished_at"
+)
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS archive.orders (
+        id INTEGER PRIMARY KEY,
+        customer_id INTEGER NOT NULL,
+        stall_id INTEGER NOT NULL,
+        price INTEGER,
+        token INTEGER NOT NULL,
+        token_day TEXT NOT NULL DEFAULT '',
+        status TEXT NOT NULL,
+        created_at DATETIME,
+        accepted_at DATETIME,
+        prep_time INTEGER,
+        is_deleted INTEGER DEFAULT 0,
+        total_price INTEGER,
+        items_summary TEXT,
+        prep_total INTEGER,
+        customer_rank INTEGER,
+        archived_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        finished_at DATETIME
+    )
+    """,
+    # product name / image are copied in: archived history must not change
+    # (or vanish) when the product is edited or deleted later
+    """
+    CREATE TABLE IF NOT EXISTS archive.order_items (
+        id INTEGER PRIMARY KEY,
+        order_id INTEGER NOT NULL,
+        product_id INTEGER,
+        quantity INTEGER,
+        product_name TEXT,
+        image TEXT,
+        image_width INTEGER,
+        image_height INTEGER
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_orders_customer ON orders(customer_id, id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_items_order ON order_items(order_id, id)",
+)
+
+
+class OrderArchive:
+    # Finished orders (ready / rejected / cancelled) older than `days` move,
+    # with their items, from the main database into a separate archive file,
+    # `batch` orders at a time, so the hot orders table only holds
+    # recent and open orders. Customer order history reads the archive only
+    # when a page reaches back into it.
+    #
+    # A transaction over ATTACHed databases is not atomic in WAL mode, so a
+    # batch moves in two, each writing one file: INSERT OR IGNORE into the
+    # archive and commit, then DELETE from main and commit. A sweep stopped
+    # between the two leaves the orders in both files (readers skip the
+    # archive copy of an id main still has) and the next sweep finishes the
+    # move; an order is never missing from both.
+
+    def __init__(self, database, path, days=30, batch=500, interval=3600, tombstone_days=7):
+        self.database = database
+        self.path = path
+        self.days = max(1, days)
+        self.tombstone_days = tombstone_days
+        self.batch = batch
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = None
+        self._stats = {"runs": 0, "moved": 0, "pruned": 0, "reads": 0, "last_run": None}
+
+    # ---------- moving ----------
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name="order-archive", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception:
+                # database busy etc.: next round picks it up
+                pass
+            time.sleep(self.interval)
+
+    def _move_batch(self, db, cutoff):
+        # 1) copy into the archive file; deferred, so main is only read
+        db.execute("BEGIN")
+        try:
+            ids = [row[0] for row in db.execute("""
+                SELECT id FROM main.orders
+                WHERE status IN ('ready', 'rejected', 'cancelled')
+                AND created_at < ?
+                LIMIT ?
+            """, (cutoff, self.batch))]
+            if ids:
+                marks = ",".join("?" * len(ids))
+                db.execute("""
+                    INSERT OR IGNORE INTO archive.orders (%s)
+                    SELECT %s FROM main.orders WHERE id IN (%s)
+                """ % (ORDER_COLUMNS, ORDER_COLUMNS, marks), ids)
+                db.execute("""
+                    INSERT OR IGNORE INTO archive.order_items
+                    (id, order_id, product_id, quantity, product_name, image, image_width, image_height)
+                    SELECT oi.id, oi.order_id, oi.product_id, oi.quantity,
+                           COALESCE(p.product_name, '[Deleted Product]'),
+                           p.image, p.image_width, p.image_height
+                    FROM main.order_items oi
+                    LEFT JOIN main.products p ON p.id = oi.product_id
+                    WHERE oi.order_id IN (%s)
+                """ % marks, ids)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        if not ids:
+            return 0
+
+        # 2) delete from main what the archive now holds
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            moved = "SELECT id FROM archive.orders WHERE id IN (%s)" % marks
+            db.execute("DELETE FROM main.order_items WHERE order_id IN (%s)" % moved, ids)
+            db.execute("DELETE FROM main.orders WHERE id IN (%s)" % moved, ids)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        return len(ids)
+
+    def _prune_deleted(self, db):
+        # forget delete tombstones (db.py migration 8) older than
+        # `tombstone_days`; API clients with an older cursor get a snapshot
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=self.tombstone_days)).strftime("%Y-%m-%d %H:%M:%S")
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("""
+                UPDATE main.change_cursor SET pruned_seq = max(pruned_seq, COALESCE(
+                    (SELECT MAX(change_seq) FROM main.deleted_rows WHERE deleted_at < ?), 0))
+                WHERE id = 1
+            """, (cutoff,))
+            count = db.execute("DELETE FROM main.deleted_rows WHERE deleted_at < ?", (cutoff,)).rowcount
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        return count
+
+    def sweep(self):
+        # returns the number of orders moved in this run
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=self.days)).strftime("%Y-%m-%d %H:%M:%S")
+        db = sqlite3.connect(self.database, timeout=30, isolation_level=None)
+        moved = 0
+        try:
+            db.execute("PRAGMA busy_timeout=10000")
+            db.execute("ATTACH DATABASE ? AS archive", (self.path,))
+            for sql in SCHEMA:
+                db.execute(sql)
+            # archives made before orders had finished_at (sales rollups)
+            columns = [row[1] for row in db.execute("PRAGMA archive.table_info(orders)")]
+            if "finished_at" not in columns:
+                db.execute("ALTER TABLE archive.orders ADD COLUMN finished_at DATETIME")
+            while True:
+                count = self._move_batch(db, cutoff)
+                moved += count
+                if count < self.batch:
+                    break
+            pruned = self._prune_deleted(db)
+        finally:
+            db.close()
+
+        with self._lock:
+            self._stats["runs"] += 1
+            self._stats["moved"] += moved
+            self._stats["pruned"] += pruned
+            self._stats["last_run"] = datetime.now(timezone.utc).isoformat()
+        return moved
+
+    # ---------- reading ----------
+
+    def _reader(self):
+        # one read connection per thread; None until something was archived
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            local.conn = None
+            local.pid = os.getpid()
+        if local.conn is None:
+            if not os.path.exists(self.path):
+                return None
+            local.conn = sqlite3.connect("file:%s?mode=ro" % self.path, uri=True, timeout=10)
+            local.conn.row_factory = sqlite3.Row
+        return local.conn
+
+    def customer_rows(self, customer_id, before=None, after=None, limit=None):
+        # archived orders of a customer with after < id < before, newest
+        # first, shaped like customer_order_rows()
+        db = self._reader()
+        if db is None:
+            return []
+        sql = """
+            SELECT id, stall_id, token, status,
+                   COALESCE(total_price, price) AS total_price,
+                   accepted_at, items_summary AS item, prep_total AS prep_time,
+                   customer_rank
+            FROM orders WHERE customer_id = ?
+        """
+        params = [customer_id]
+        if before is not None:
+            sql += " AND id < ?"
+            params.append(before)
+        if after is not None:
+            sql += " AND id > ?"
+            params.append(after)
+        sql += " ORDER BY id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        try:
+            rows = db.execute(sql, params).fetchall()
+        except sqlite3.OperationalError:
+            # file exists but no sweep has created the tables yet
+            return []
+        with self._lock:
+            self._stats["reads"] += 1
+        return rows
+
+    def items(self, order_ids):
+        # {order_id: [rows]} like load_order_items()
+        items = {order_id: [] for order_id in order_ids}
+        db = self._reader()
+        if db is None or not items:
+            return items
+        ids = list(items)
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            for row in db.execute("""
+                SELECT order_id, product_name, quantity, image, image_width, image_height
+                FROM order_items WHERE order_id IN (%s)
+                ORDER BY order_id, id
+            """ % ",".join("?" * len(chunk)), chunk):
+                items[row["order_id"]].append(row)
+        return items
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
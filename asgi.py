@@ -0,0 +1,329 @@
+import asyncio, io, json, os, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode
+
+import app as takego
+from asyncdb import AsyncDatabase
+
+# ================= ASGI ENTRY POINT =================
+# uvicorn asgi:app --workers 2
+# Serves the same Flask routes from an event loop. Ordinary requests run
+# the Flask app on a thread pool (ASGI_THREADS); the two routes that sit
+# idle for most of their life, the owner's order stream and the customer
+# page's /current_tokens long-poll, are answered here as coroutines, so an
+# idle client costs no thread and a process can hold thousands of them.
+# Their database work goes through AsyncDatabase. Everything else (menus,
+# /generate_token, the owner dashboards, /refresh) is synchronous Flask
+# code: its sqlite3 calls block a bridge thread, never the loop, and are
+# not rewritten as coroutines.
+
+flask_app = takego.app
+adb = AsyncDatabase(takego.pool, workers=int(os.environ.get("ASYNC_DB_THREADS", 8)))
+THREADS = int(os.environ.get("ASGI_THREADS", 32))
+
+
+class ChangeWaiters:
+    # asyncio.Events woken on every published order change. ChangeNotifier
+    # calls listeners on the writer's thread, so the wake-up is handed to
+    # the loop.
+
+    def __init__(self, changes):
+        self._loop = None
+        self._events = set()
+        changes.subscribe(self._published)
+
+    def watch(self, event):
+        self._loop = asyncio.get_running_loop()
+        self._events.add(event)
+
+    def unwatch(self, event):
+        self._events.discard(event)
+
+    def _published(self, stall_id, order_ids):
+        loop = self._loop
+        if loop is not None and self._events:
+            loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        for event in list(self._events):
+            event.set()
+
+    def __len__(self):
+        return len(self._events)
+
+
+waiters = ChangeWaiters(takego.changes)
+
+_lock = threading.Lock()
+_executor = None
+_pid = None
+_stats = {"bridged": 0, "streams": 0, "long_polls": 0}
+
+
+def executor():
+    global _executor, _pid
+    if _pid != os.getpid():
+        with _lock:
+            if _pid != os.getpid():
+                _executor = ThreadPoolExecutor(THREADS, thread_name_prefix="asgi-wsgi")
+                _pid = os.getpid()
+    return _executor
+
+
+def count(key):
+    with _lock:
+        _stats[key] += 1
+
+
+async def in_thread(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor(), fn, *args)
+
+
+# ================= WSGI BRIDGE =================
+
+def wsgi_environ(scope, body, query_string=None):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": (scope["query_string"] if query_string is None else query_string).decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+            continue
+        if name == "CONTENT_LENGTH":
+            continue
+        key = "HTTP_" + name
+        if key in environ:
+            value = environ[key] + ("; " if key == "HTTP_COOKIE" else ",") + value
+        environ[key] = value
+    return environ
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+def _start_wsgi(environ):
+    # (status, headers, body or None, iterator): a response with a
+    # Content-Length is read whole here; anything else streams
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = headers
+
+    result = flask_app(environ, start_response)
+    if any(name.lower() == "content-length" for name, _ in started["headers"]):
+        try:
+            return started["status"], started["headers"], b"".join(result), None
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+    return started["status"], started["headers"], None, result
+
+
+def _next_chunk(iterator):
+    return next(iterator, None)
+
+
+async def send_start(send, status, headers):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+    })
+
+
+async def call_wsgi(scope, receive, send, query_string=None):
+    body = await read_body(receive)
+    environ = wsgi_environ(scope, body, query_string)
+    count("bridged")
+    status, headers, body, result = await in_thread(_start_wsgi, environ)
+    await send_start(send, status, headers)
+    if result is None:
+        await send({"type": "http.response.body", "body": body})
+        return
+    try:
+        iterator = iter(result)
+        while True:
+            chunk = await in_thread(_next_chunk, iterator)
+            if chunk is None:
+                break
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(result, "close"):
+            await in_thread(result.close)
+
+
+async def send_simple(send, status, body=b"", content_type="text/plain"):
+    await send_start(send, status, [("Content-Type", content_type), ("Content-Length", str(len(body)))])
+    await send({"type": "http.response.body", "body": body})
+
+
+# ================= NATIVE ROUTES =================
+
+def _stream_owner(environ):
+    # session cookie -> owner, inside a Flask request context
+    with flask_app.request_context(environ):
+        return takego.order_stream_owner()
+
+
+async def owner_orders_stream(scope, receive, send):
+    # same events as the Flask route, without a thread per open stream
+    target, status = await in_thread(_stream_owner, wsgi_environ(scope, b""))
+    if not target:
+        return await send_simple(send, status)
+    owner_id, stall_id = target
+    headers = dict((k.decode("latin-1").lower(), v.decode("latin-1")) for k, v in scope["headers"])
+    last = takego.stream_since(headers.get("last-event-id"))
+
+    wake, gone = asyncio.Event(), asyncio.Event()
+
+    async def watch_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        gone.set()
+        wake.set()
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+    waiters.watch(wake)
+    count("streams")
+    try:
+        await send_start(send, 200, [
+            ("Content-Type", "text/event-stream; charset=utf-8"),
+            ("Cache-Control", "no-cache"),
+            ("X-Accel-Buffering", "no"),
+        ])
+        await send({"type": "http.response.body", "body": b"retry: 3000\n\n", "more_body": True})
+        while not gone.is_set():
+            # cleared before looking, so a change published meanwhile still wakes us
+            wake.clear()
+            seq, order_ids = takego.changes.changes_since(stall_id, last)
+            if order_ids is None:
+                event = "id: %d\nevent: reset\ndata: {}\n\n" % seq
+            elif order_ids:
+                data = await adb.run(takego.owner_changed_rows, owner_id, stall_id, order_ids)
+                event = "id: %d\nevent: orders\ndata: %s\n\n" % (seq, json.dumps(data))
+            else:
+                last = seq
+                try:
+                    await asyncio.wait_for(wake.wait(), takego.SSE_KEEPALIVE)
+                    continue
+                except asyncio.TimeoutError:
+                    event = ": ping\n\n"
+            last = seq
+            await send({"type": "http.response.body", "body": event.encode(), "more_body": True})
+    finally:
+        waiters.unwatch(wake)
+        watcher.cancel()
+
+
+def _token_counters(raw):
+    with flask_app.app_context():
+        return takego.token_counters(raw)
+
+
+async def current_tokens(scope, receive, send):
+    # waits here for the version to move, then lets Flask answer
+    query = parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True)
+    args = dict(query)
+    try:
+        wait = min(float(args.get("wait", 0)), takego.TOKENS_MAX_WAIT)
+    except ValueError:
+        wait = 0
+    version = args.get("version")
+    if wait <= 0 or not version:
+        return await call_wsgi(scope, receive, send)
+    try:
+        _, counters, _ = await in_thread(_token_counters, args.get("stall_ids", "all"))
+    except ValueError:
+        return await call_wsgi(scope, receive, send)
+
+    deadline = time.monotonic() + wait
+    wake = asyncio.Event()
+    waiters.watch(wake)
+    count("long_polls")
+    try:
+        while True:
+            wake.clear()
+            tag, _ = await adb.call(takego.version_tag, counters)
+            left = deadline - time.monotonic()
+            if tag != version or left <= 0:
+                break
+            # short slices so writes from other workers (shared versions) are seen too
+            try:
+                await asyncio.wait_for(wake.wait(), min(left, 1.0))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        waiters.unwatch(wake)
+
+    rest = urlencode([(k, v) for k, v in query if k != "wait"]).encode("latin-1")
+    await call_wsgi(scope, receive, send, query_string=rest)
+
+
+async def async_health(scope, receive, send):
+    with _lock:
+        data = dict(_stats)
+    data.update(threads=THREADS, waiting=len(waiters), db=adb.stats())
+    await send_simple(send, 200, json.dumps(data).encode(), "application/json")
+
+
+NATIVE = {
+    "/owner_orders/stream": owner_orders_stream,
+    "/current_tokens": current_tokens,
+    "/health/async": async_health,
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            adb.shutdown()
+            if _executor is not None and _pid == os.getpid():
+                _executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    handler = NATIVE.get(scope["path"])
+    if handler is not None and scope["method"] == "GET":
+        return await handler(scope, receive, send)
+    await call_wsgi(scope, receive, send)
@@ -0,0 +1,63 @@
+import asyncio, os, threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncDatabase:
+    # SQLite for coroutines. sqlite3 calls block, so each call runs on a
+    # small thread pool against the app's ConnectionPool and the event loop
+    # only awaits the result. `workers` caps the queries running at once;
+    # keep it at or below the pool size so no thread waits on a connection.
+
+    def __init__(self, pool, workers=8):
+        self.pool = pool
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._stats = {"calls": 0, "errors": 0, "running": 0, "max_running": 0}
+
+    def _pool(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="async-db")
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _call(self, fn, args):
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["running"] += 1
+            self._stats["max_running"] = max(self._stats["max_running"], self._stats["running"])
+        try:
+            return fn(*args)
+        except Exception:
+            with self._lock:
+                self._stats["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                self._stats["running"] -= 1
+
+    def _with_connection(self, fn, *args):
+        with self.pool.connection() as db:
+            return fn(db, *args)
+
+    async def call(self, fn, *args):
+        # fn(*args) off the event loop, for code that opens its own connection
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool(), self._call, fn, args)
+
+    async def run(self, fn, *args):
+        # fn(db, *args) with a pooled connection
+        return await self.call(self._with_connection, fn, *args)
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False)
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+        data["workers"] = self.workers
+        return data
@@ -0,0 +1,261 @@
+import hashlib, math, os, threading, time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+
+def token_digest(token):
+    # refresh tokens are looked up by digest so the lookup key is short,
+    # fixed size and never the bearer secret itself
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def utcnow():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class BloomFilter:
+    # k bit positions per key, all taken from one sha256 of the key
+
+    def __init__(self, capacity=100000, error_rate=0.001):
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = min(8, max(1, round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.sha256(key.encode()).digest()
+        for i in range(self.hashes):
+            yield int.from_bytes(digest[i * 4:i * 4 + 4], "big") % self.size
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class RevocationList:
+    # Revoked session ids (the `sid` shared by a refresh token and the
+    # access tokens issued from it). Most checks end at the bloom filter:
+    # a miss means "not revoked" without touching the database. A hit is
+    # confirmed against an LRU of exact answers and only then the database.
+    #
+    # Logouts in this worker are added at once; logouts in other workers
+    # are picked up by sync() every `interval` seconds. Expired sessions
+    # drop out when the filter is rebuilt every `rebuild_every` seconds.
+
+    def __init__(self, pool, capacity=100000, lru_size=10000, interval=5, rebuild_every=3600):
+        self.pool = pool
+        self.capacity = capacity
+        self.lru_size = lru_size
+        self.interval = interval
+        self.rebuild_every = rebuild_every
+        self._lock = threading.Lock()
+        self._bloom = BloomFilter(capacity)
+        self._lru = OrderedDict()       # sid -> revoked (bool)
+        self._watermark = ""            # newest revoked_at seen
+        self._synced = 0.0
+        self._rebuilt = 0.0
+        self._stats = {"checks": 0, "bloom_hits": 0, "lru_hits": 0, "db_checks": 0}
+
+    def _remember(self, sid, revoked):
+        self._lru[sid] = revoked
+        self._lru.move_to_end(sid)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def add(self, sid):
+        with self._lock:
+            self._bloom.add(sid)
+            self._remember(sid, True)
+
+    def _load(self, db, since=None):
+        if since is None:
+            return db.execute("""
+                SELECT sid, revoked_at FROM refresh_tokens
+                WHERE revoked_at IS NOT NULL AND expires_at > ?
+            """, (utcnow(),)).fetchall()
+        return db.execute("""
+            SELECT sid, revoked_at FROM refresh_tokens
+            WHERE revoked_at > ?
+        """, (since,)).fetchall()
+
+    def rebuild(self, db):
+        rows = self._load(db)
+        bloom = BloomFilter(max(self.capacity, len(rows) * 2))
+        for sid, revoked_at in rows:
+            bloom.add(sid)
+        with self._lock:
+            self._bloom = bloom
+            self._lru.clear()
+            self._watermark = max((r[1] for r in rows), default="")
+            self._synced = self._rebuilt = time.monotonic()
+
+    def sync(self, db):
+        # look a few seconds behind the watermark: a logout stamped earlier
+        # may commit after a later one we have already seen
+        since = self._watermark
+        if since:
+            since = (datetime.fromisoformat(since) - timedelta(seconds=5)).isoformat()
+        rows = self._load(db, since)
+        with self._lock:
+            for sid, revoked_at in rows:
+                self._bloom.add(sid)
+                self._remember(sid, True)
+                self._watermark = max(self._watermark, revoked_at)
+            self._synced = time.monotonic()
+
+    def refresh(self):
+        now = time.monotonic()
+        if now - self._synced < self.interval:
+            return
+        with self.pool.connection() as db:
+            if now - self._rebuilt >= self.rebuild_every:
+                self.rebuild(db)
+            else:
+                self.sync(db)
+
+    def is_revoked(self, sid):
+        self.refresh()
+        with self._lock:
+            self._stats["checks"] += 1
+            if sid not in self._bloom:
+                return False
+            self._stats["bloom_hits"] += 1
+            if sid in self._lru:
+                self._stats["lru_hits"] += 1
+                self._lru.move_to_end(sid)
+                return self._lru[sid]
+            self._stats["db_checks"] += 1
+
+        # bloom false positive or an answer evicted from the LRU
+        with self.pool.connection() as db:
+            row = db.execute(
+                "SELECT 1 FROM refresh_tokens WHERE sid = ? AND revoked_at IS NOT NULL",
+                (sid,)
+            ).fetchone()
+        with self._lock:
+            self._remember(sid, row is not None)
+        return row is not None
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["bloom_entries"] = self._bloom.count
+            data["bloom_bits"] = self._bloom.size
+            data["lru"] = len(self._lru)
+        return data
+
+
+def cap_sessions(db, user_id, keep):
+    # revoke all but the `keep` newest live sessions of a user; returns the
+    # revoked sids. The caller commits.
+    return [sid for (sid,) in db.execute("""
+        UPDATE refresh_tokens SET revoked_at = ?
+        WHERE id IN (
+            SELECT id FROM refresh_tokens
+            WHERE user_id = ? AND revoked_at IS NULL
+            ORDER BY created_at DESC, id DESC
+            LIMIT -1 OFFSET ?
+        )
+        RETURNING sid
+    """, (utcnow(), user_id, keep)).fetchall()]
+
+
+class SessionJanitor:
+    # Background thread that keeps refresh_tokens small. Every `interval`
+    # seconds it deletes expired rows, and revoked rows older than `grace`
+    # (long enough for any access token issued from them to have expired),
+    # `chunk` rows per transaction so logins never wait long on the write
+    # lock. Users over `max_sessions` live sessions lose the oldest ones.
+    #
+    # Each worker runs one; the statements are idempotent so overlapping
+    # sweeps only cost a little extra work.
+
+    def __init__(self, pool, revocations=None, interval=600, chunk=500,
+                 max_sessions=10, grace=timedelta(hours=1)):
+        self.pool = pool
+        self.revocations = revocations
+        self.interval = interval
+        self.chunk = chunk
+        self.max_sessions = max_sessions
+        self.grace = grace
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stats = {"runs": 0, "deleted": 0, "capped": 0, "bytes": 0, "last_run": None}
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name="session-janitor", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception:
+                # database busy etc.: next round picks it up
+                pass
+            time.sleep(self.interval)
+
+    def _free_bytes(self, db):
+        page_size = db.execute("PRAGMA page_size").fetchone()[0]
+        return db.execute("PRAGMA freelist_count").fetchone()[0] * page_size
+
+    def _delete_chunks(self, db, where, params):
+        deleted = 0
+        while True:
+            count = db.execute("""
+                DELETE FROM refresh_tokens WHERE id IN (
+                    SELECT id FROM refresh_tokens WHERE %s LIMIT ?
+                )
+            """ % where, params + (self.chunk,)).rowcount
+            db.commit()
+            deleted += count
+            if count < self.chunk:
+                return deleted
+
+    def sweep(self):
+        # returns {"deleted", "capped", "bytes"} for this run; bytes are the
+        # pages handed back to SQLite's freelist for reuse
+        now = datetime.now(timezone.utc)
+        with self.pool.connection() as db:
+            before = self._free_bytes(db)
+            deleted = self._delete_chunks(db, "expires_at < ?", (now.isoformat(),))
+            deleted += self._delete_chunks(
+                db, "revoked_at < ?", ((now - self.grace).isoformat(),)
+            )
+
+            capped = []
+            over = db.execute("""
+                SELECT user_id FROM refresh_tokens
+                WHERE revoked_at IS NULL
+                GROUP BY user_id HAVING COUNT(*) > ?
+            """, (self.max_sessions,)).fetchall()
+            for (user_id,) in over:
+                capped += cap_sessions(db, user_id, self.max_sessions)
+                db.commit()
+            reclaimed = max(0, self._free_bytes(db) - before)
+
+        if self.revocations:
+            for sid in capped:
+                self.revocations.add(sid)
+
+        result = {"deleted": deleted, "capped": len(capped), "bytes": reclaimed}
+        with self._lock:
+            self._stats["runs"] += 1
+            self._stats["deleted"] += deleted
+            self._stats["capped"] += len(capped)
+            self._stats["bytes"] += reclaimed
+            self._stats["last_run"] = now.isoformat()
+        return result
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
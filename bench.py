@@ -0,0 +1,476 @@
+import argparse, http.client, json, os, random, shutil, sqlite3, subprocess, sys, tempfile, threading, time
+from datetime import datetime, timedelta, timezone
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+# ================= BENCHMARK =================
+# python bench.py [--orders 20000] [--target client,gunicorn] [--out run.json]
+# Seeds a fresh database with the schema from db.py, logs a few owners and
+# customers in and times the ordering hot paths, first in-process through
+# the Flask test client (app cost only) and then over HTTP against a local
+# gunicorn; --target uvicorn runs the async entry point (asgi.py) instead.
+# --idle N parks N long-polling clients on the server for the whole run.
+# Prints one JSON document; pass --baseline <old.json> to compare against
+# an earlier run and exit 1 when a p50 got slower than --tolerance.
+
+PASSWORD = "bench-password"
+
+# run in this order: /login adds refresh tokens and could log out the
+# sessions the other scenarios use, so it goes last
+SCENARIOS = [
+    "current_token", "refresh", "owner_orders", "owner_orders_partial",
+    "order_history", "generate_token", "login",
+]
+
+STATUSES = ["pending"] * 2 + ["accepted"] * 2 + ["ready"] * 4 + ["rejected", "cancelled"]
+
+
+# ================= SEEDING =================
+
+def seed(path, stalls=20, products=15, customers=200, orders=20000, seed=1):
+    # deterministic for a given seed; every user's password is PASSWORD
+    from db import init_db
+    from werkzeug.security import generate_password_hash
+
+    rnd = random.Random(seed)
+    init_db(path)
+    db = sqlite3.connect(path)
+    hashed = generate_password_hash(PASSWORD, method=os.environ.get("PASSWORD_METHOD", "scrypt"))
+
+    db.executemany(
+        "INSERT INTO users (username, password, role, terms_accepted) VALUES (?, ?, ?, 1)",
+        [("owner%d" % i, hashed, "owner") for i in range(1, stalls + 1)]
+        + [("customer%d" % i, hashed, "customer") for i in range(1, customers + 1)]
+    )
+    db.executemany(
+        "INSERT INTO stalls (id, owner_id, stall_name) VALUES (?, ?, ?)",
+        [(i, i, "Stall %d" % i) for i in range(1, stalls + 1)]
+    )
+    menu = {}
+    for stall_id in range(1, stalls + 1):
+        menu[stall_id] = []
+        for n in range(products):
+            price, prep = rnd.randint(20, 300), rnd.randint(2, 15)
+            product_id = db.execute("""
+                INSERT INTO products (stall_id, product_name, price, prep_time, availability)
+                VALUES (?, ?, ?, ?, ?)
+            """, (stall_id, "Item %d-%d" % (stall_id, n + 1), price, prep, 10 ** 9)).lastrowid
+            menu[stall_id].append((product_id, price, prep))
+
+    # recent enough that the archive sweep leaves them where they are
+    now = datetime.now(timezone.utc)
+    tokens = {stall_id: 0 for stall_id in menu}
+    for _ in range(orders):
+        stall_id = rnd.randint(1, stalls)
+        customer_id = stalls + rnd.randint(1, customers)
+        lines = rnd.sample(menu[stall_id], min(len(menu[stall_id]), rnd.randint(1, 3)))
+        quantities = [rnd.randint(1, 3) for _ in lines]
+        status = rnd.choice(STATUSES)
+        created = now - timedelta(minutes=rnd.randint(1, 7 * 24 * 60))
+        tokens[stall_id] += 1
+        order_id = db.execute("""
+            INSERT INTO orders (customer_id, stall_id, price, token, status, created_at, accepted_at, prep_time,
+                                total_price, items_summary, prep_total)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            customer_id, stall_id, sum(p[1] * q for p, q in zip(lines, quantities)), tokens[stall_id], status,
+            created.strftime("%Y-%m-%d %H:%M:%S"),
+            now.isoformat() if status == "accepted" else None,
+            sum(p[2] * q for p, q in zip(lines, quantities)) if status == "accepted" else None,
+            sum(p[1] * q for p, q in zip(lines, quantities)),
+            ",".join("Item %d-%d x %d" % (stall_id, menu[stall_id].index(p) + 1, q) for p, q in zip(lines, quantities)),
+            sum(p[2] * q for p, q in zip(lines, quantities)),
+        )).lastrowid
+        db.executemany(
+            "INSERT INTO order_items (order_id, product_id, quantity) VALUES (?, ?, ?)",
+            [(order_id, p[0], q) for p, q in zip(lines, quantities)]
+        )
+    db.executemany(
+        "INSERT INTO stall_sequences (stall_id, last_token, token_day) VALUES (?, ?, '')",
+        list(tokens.items())
+    )
+    db.commit()
+    db.execute("ANALYZE")
+    db.close()
+
+
+# ================= TRANSPORTS =================
+# request(method, path, form, cookies) -> (status, {cookie: value}); one
+# connection / test client per thread
+
+class ClientTransport:
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, form=None, cookies=None):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client(use_cookies=False)
+        headers = {"Cookie": cookie_header(cookies)} if cookies else {}
+        resp = client.open(path, method=method, data=form, headers=headers)
+        resp.get_data()
+        return resp.status_code, parse_cookies(resp.headers.getlist("Set-Cookie"))
+
+    def close(self):
+        pass
+
+
+class HTTPTransport:
+
+    def __init__(self, host, port, timeout=30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def request(self, method, path, form=None, cookies=None):
+        headers = {"Cookie": cookie_header(cookies)} if cookies else {}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        for attempt in (0, 1):
+            conn = getattr(self._local, "conn", None)
+            if conn is None:
+                conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+            except TimeoutError:
+                # the request may still run on the server: never resend it
+                conn.close()
+                self._local.conn = None
+                raise
+            except (http.client.HTTPException, ConnectionError):
+                # keep-alive connection closed by the server: reconnect once
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+                continue
+            if resp.will_close:
+                conn.close()
+                self._local.conn = None
+            return resp.status, parse_cookies(resp.headers.get_all("Set-Cookie") or [])
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+
+
+def cookie_header(cookies):
+    return "; ".join("%s=%s" % item for item in cookies.items())
+
+
+def parse_cookies(headers):
+    jar = SimpleCookie()
+    for header in headers:
+        jar.load(header)
+    return {name: morsel.value for name, morsel in jar.items()}
+
+
+# ================= SCENARIOS =================
+
+def login(transport, username):
+    status, cookies = transport.request("POST", "/login", {"username": username, "password": PASSWORD})
+    if status != 200 or "refresh_token" not in cookies:
+        raise RuntimeError("login as %s failed (%d)" % (username, status))
+    return cookies
+
+
+def build_requests(name, owners, customers, args):
+    # request number i -> (method, path, form, cookies)
+    if name == "login":
+        return lambda i: ("POST", "/login", {"username": "customer%d" % (i % args.customers + 1), "password": PASSWORD}, None)
+    if name == "generate_token":
+        def make(i):
+            stall_id = i % args.stalls + 1
+            product_id = (stall_id - 1) * args.products + i % args.products + 1
+            return "POST", "/generate_token", {"product_id": product_id, "quantity": 1}, customers[i % len(customers)]
+        return make
+    if name == "current_token":
+        return lambda i: ("GET", "/current_token?stall_id=%d" % (i % args.stalls + 1), None, None)
+    if name == "refresh":
+        return lambda i: ("POST", "/refresh", None, {"refresh_token": customers[i % len(customers)]["refresh_token"]})
+    if name == "order_history":
+        return lambda i: ("GET", "/order_history", None, customers[i % len(customers)])
+    return lambda i: ("GET", "/" + name, None, owners[i % len(owners)])
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def run_scenario(transport, make, requests, concurrency, warmup):
+    for i in range(warmup):
+        try:
+            transport.request(*make(i))
+        except Exception:
+            pass
+
+    latencies = []
+    errors = {}
+    lock = threading.Lock()
+    counter = iter(range(warmup, warmup + requests))
+
+    def worker():
+        mine, failed = [], {}
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            started = time.perf_counter()
+            try:
+                status, _ = transport.request(*make(i))
+            except Exception as exc:
+                status = type(exc).__name__
+            mine.append(time.perf_counter() - started)
+            if not isinstance(status, int) or status >= 400:
+                failed[str(status)] = failed.get(str(status), 0) + 1
+        with lock:
+            latencies.extend(mine)
+            for key, count in failed.items():
+                errors[key] = errors.get(key, 0) + count
+        transport.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2),
+    }
+
+
+def run_target(transport, args, idle=None):
+    owners = [login(transport, "owner%d" % (i + 1)) for i in range(min(args.sessions, args.stalls))]
+    customers = [login(transport, "customer%d" % (i + 1)) for i in range(min(args.sessions, args.customers))]
+    if idle is not None:
+        idle.start()
+    results = {}
+    for name in SCENARIOS:
+        if name not in args.scenarios:
+            continue
+        requests = args.requests
+        if name == "login":
+            # a password hash per request; scrypt is deliberately slow
+            requests = max(1, requests // 10)
+        make = build_requests(name, owners, customers, args)
+        results[name] = run_scenario(transport, make, requests, args.concurrency, min(args.warmup, requests))
+        print("  %-22s %8.1f req/s  p50 %7.2f ms  p99 %7.2f ms%s" % (
+            name, results[name]["rps"], results[name]["p50_ms"], results[name]["p99_ms"],
+            "  errors %s" % results[name]["errors"] if results[name]["errors"] else ""), file=sys.stderr)
+    return results
+
+
+# ================= SERVERS =================
+# gunicorn runs the WSGI app (app.py) on gthread workers, or the async
+# entry point (asgi.py) on uvicorn workers. (`uvicorn --workers` hands its
+# socket to spawned children without TCP_NODELAY, which adds ~40 ms to
+# every response, so it is not used here.)
+
+def server_command(target, args):
+    cmd = [
+        sys.executable, "-m", "gunicorn",
+        "--bind", "127.0.0.1:%d" % args.port,
+        "--workers", str(args.workers),
+        "--log-level", "warning",
+    ]
+    if target == "gunicorn":
+        return cmd + ["--worker-class", "gthread", "--threads", str(args.threads), "app:app"]
+    return cmd + ["--worker-class", "uvicorn.workers.UvicornWorker", "asgi:app"]
+
+
+def start_server(target, env, args):
+    proc = subprocess.Popen(server_command(target, args), env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("%s exited with %d" % (target, proc.returncode))
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", args.port, timeout=2)
+            conn.request("GET", "/health/db")
+            conn.getresponse().read()
+            conn.close()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("%s did not start on port %d" % (target, args.port))
+
+
+class IdleClients:
+    # `count` customer pages parked on the /current_tokens long-poll for
+    # the whole run, like browsers left open; each holds a connection (and,
+    # under a sync server, a worker thread) while it waits
+
+    def __init__(self, port, count, wait=25):
+        self.port = port
+        self.count = count
+        self.wait = wait
+        self.stop = threading.Event()
+        self.polls = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        for _ in range(self.count):
+            threading.Thread(target=self._poll, daemon=True).start()
+
+    def _get(self, conn, path):
+        conn.request("GET", path)
+        resp = conn.getresponse()
+        return json.loads(resp.read() or b"{}")
+
+    def _poll(self):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=self.wait + 30)
+        try:
+            version = self._get(conn, "/current_tokens?stall_ids=all").get("version")
+            while not self.stop.is_set():
+                version = self._get(conn, "/current_tokens?stall_ids=all&version=%s&wait=%d" % (version, self.wait)).get("version")
+                with self._lock:
+                    self.polls += 1
+        except Exception:
+            pass
+        finally:
+            conn.close()
+
+
+# ================= REPORT =================
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(report, baseline, tolerance):
+    # slower p50s than baseline * (1 + tolerance), as lines of text
+    regressions = []
+    for target, scenarios in report["results"].items():
+        for name, result in scenarios.items():
+            old = baseline.get("results", {}).get(target, {}).get(name)
+            if not old:
+                continue
+            change = result["p50_ms"] / old["p50_ms"] - 1 if old["p50_ms"] else 0
+            print("  %-8s %-22s p50 %7.2f -> %7.2f ms (%+.0f%%)" % (
+                target, name, old["p50_ms"], result["p50_ms"], change * 100), file=sys.stderr)
+            if change > tolerance:
+                regressions.append("%s %s p50 %+.0f%%" % (target, name, change * 100))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ordering hot paths")
+    parser.add_argument("--stalls", type=int, default=20)
+    parser.add_argument("--products", type=int, default=15, help="per stall")
+    parser.add_argument("--customers", type=int, default=200)
+    parser.add_argument("--orders", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--database", help="keep the seeded database here (default: a temp dir)")
+    parser.add_argument("--target", default="client,gunicorn", help="comma-separated: client, gunicorn, uvicorn")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=500, help="per scenario (/login gets a tenth)")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8, help="client threads")
+    parser.add_argument("--sessions", type=int, default=20, help="logged-in owners / customers")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=4, help="threads per gunicorn worker")
+    parser.add_argument("--idle", type=int, default=0, help="long-poll clients kept waiting during a server run")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds before an HTTP request counts as failed")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--out", help="also write the JSON report here")
+    parser.add_argument("--baseline", help="earlier report to compare p50s against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p50 slowdown vs baseline")
+    args = parser.parse_args(argv)
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    targets = [t for t in args.target.split(",") if t]
+
+    # every file the app writes lives next to the seeded database
+    workdir = tempfile.mkdtemp(prefix="takego-bench-")
+    path = os.path.abspath(args.database or os.path.join(workdir, "bench.db"))
+    if os.path.exists(path):
+        os.unlink(path)
+    env = dict(os.environ)
+    env.update({
+        "DATABASE": path,
+        "SESSION_DB": os.path.join(workdir, "sessions.db"),
+        "CACHE_DB": os.path.join(workdir, "cache.db"),
+        "ARCHIVE_DB": os.path.join(workdir, "archive.db"),
+        "WRITE_SOCKET": os.path.join(workdir, "writer.sock"),
+    })
+
+    started = time.perf_counter()
+    seed(path, args.stalls, args.products, args.customers, args.orders, args.seed)
+    print("seeded %s in %.1fs" % (path, time.perf_counter() - started), file=sys.stderr)
+
+    report = {
+        "commit": git_commit(),
+        "when": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline", "port")},
+        "env": {k: env[k] for k in ("WRITE_MODE", "SESSION_BACKEND", "CACHE_BACKEND", "PASSWORD_METHOD") if k in env},
+        "results": {},
+    }
+
+    for target in targets:
+        print("%s:" % target, file=sys.stderr)
+        if target == "client":
+            # same settings as gunicorn gets, applied before the app is imported
+            os.environ.update(env)
+            import app
+            report["results"]["client"] = run_target(ClientTransport(app.app), args)
+        elif target in ("gunicorn", "uvicorn"):
+            proc = start_server(target, env, args)
+            idle = IdleClients(args.port, args.idle)
+            try:
+                transport = HTTPTransport("127.0.0.1", args.port, args.timeout)
+                report["results"][target] = run_target(transport, args, idle)
+            finally:
+                idle.stop.set()
+                proc.terminate()
+                proc.wait()
+        else:
+            parser.error("unknown target %r" % target)
+
+    # a --database outside the temp dir is kept for a closer look
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("regressions: " + "; ".join(regressions), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+import sqlite3, threading, time, os, uuid
+from collections import OrderedDict
+
+
+class LocalVersions:
+    # namespace -> (version, modified), private to this process. The epoch
+    # changes on every start so versions from another process never match.
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:8]
+        self._versions = {}
+        self._started = time.time()
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        return self.stamp(name)[0]
+
+    def stamp(self, name):
+        return self._versions.get(name, (0, self._started))
+
+    def bump(self, name):
+        with self._lock:
+            version = self._versions.get(name, (0, 0))[0] + 1
+            self._versions[name] = (version, time.time())
+
+
+class SQLiteVersions:
+    # Versions shared by every worker through a small SQLite file. Reads
+    # only go back to disk when PRAGMA data_version says another process
+    # committed since the last look, so a hit costs one cheap pragma.
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _connect(self):
+        # opened lazily so a connection never crosses a gunicorn fork
+        if self._pid == os.getpid():
+            return
+        self._conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_versions (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                modified REAL NOT NULL DEFAULT 0
+            )
+        """)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(cache_versions)")]
+        if "modified" not in columns:
+            self._conn.execute("ALTER TABLE cache_versions ADD COLUMN modified REAL NOT NULL DEFAULT 0")
+        # a recreated file must not hand out version numbers seen before
+        self._conn.execute("""
+            INSERT OR IGNORE INTO cache_versions (name, version, modified)
+            VALUES ('_epoch', abs(random() % 1000000000), ?)
+        """, (time.time(),))
+        self._seen = None
+        self._versions = {}
+        self._pid = os.getpid()
+
+    def _refresh(self):
+        self._connect()
+        data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self._seen:
+            self._versions = {
+                name: (version, modified)
+                for name, version, modified in self._conn.execute(
+                    "SELECT name, version, modified FROM cache_versions"
+                )
+            }
+            self._seen = data_version
+
+    @property
+    def epoch(self):
+        return "%x" % self.stamp("_epoch")[0]
+
+    def get(self, name):
+        return self.stamp(name)[0]
+
+    def stamp(self, name):
+        with self._lock:
+            self._refresh()
+            return self._versions.get(name, (0, self._versions["_epoch"][1]))
+
+    def bump(self, name):
+        with self._lock:
+            self._connect()
+            now = time.time()
+            version = self._conn.execute("""
+                INSERT INTO cache_versions (name, version, modified) VALUES (?, 1, ?)
+                ON CONFLICT(name) DO UPDATE SET version = version + 1, modified = excluded.modified
+                RETURNING version
+            """, (name, now)).fetchone()[0]
+            self._versions[name] = (version, now)
+
+
+class ReadCache:
+    # Read-through LRU cache with a TTL. Every key belongs to a namespace
+    # (e.g. "menu:3"); invalidate(namespace) bumps its version and every
+    # entry loaded under an older version is treated as a miss.
+
+    def __init__(self, versions=None, maxsize=512, ttl=300):
+        self.versions = versions or LocalVersions()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()     # (namespace, key) -> (expires, version, value)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, namespace, key, loader):
+        version = self.versions.get(namespace)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get((namespace, key))
+            if entry and entry[0] > now and entry[1] == version:
+                self._data.move_to_end((namespace, key))
+                self._stats["hits"] += 1
+                return entry[2]
+            self._stats["misses"] += 1
+
+        value = loader()
+
+        with self._lock:
+            self._data[(namespace, key)] = (now + self.ttl, version, value)
+            self._data.move_to_end((namespace, key))
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats["evictions"] += 1
+        return value
+
+    def invalidate(self, *namespaces):
+        for namespace in namespaces:
+            self.versions.bump(namespace)
+        with self._lock:
+            self._stats["invalidations"] += len(namespaces)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["size"] = len(self._data)
+        data["backend"] = type(self.versions).__name__
+        return data
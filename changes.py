@@ -0,0 +1,72 @@
+import threading
+from collections import deque
+
+
+class ChangeNotifier:
+    # In-process feed of changed order ids. Every change gets a sequence
+    # number; readers remember the last one they saw and ask for the rest.
+
+    def __init__(self, backlog=2048):
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._log = deque(maxlen=backlog)   # (seq, stall_id, order_id)
+        self._latest = {}                   # stall_id -> last seq for that stall
+        self._listeners = []
+
+    @property
+    def seq(self):
+        return self._seq
+
+    def subscribe(self, fn):
+        # fn(stall_id, order_ids) runs on the writer's thread after publish
+        self._listeners.append(fn)
+
+    def publish(self, stall_id, order_ids):
+        stall_id = int(stall_id)
+        order_ids = [int(i) for i in order_ids]
+        with self._cond:
+            for order_id in order_ids or [0]:
+                self._seq += 1
+                self._log.append((self._seq, stall_id, order_id))
+            self._latest[stall_id] = self._seq
+            self._cond.notify_all()
+        for fn in self._listeners:
+            fn(stall_id, order_ids)
+
+    def changes_since(self, stall_id, since):
+        # returns (seq, order_ids); order_ids is None when the backlog no
+        # longer reaches back to `since` and the reader has to resync
+        with self._cond:
+            return self._collect(int(stall_id), since)
+
+    def wait(self, stall_id, since, timeout=None):
+        stall_id = int(stall_id)
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._latest.get(stall_id, 0) > since,
+                timeout,
+            )
+            return self._collect(stall_id, since)
+
+    def wait_any(self, stall_ids, since, timeout=None):
+        # wake on a change to any of stall_ids (None: any stall); returns seq
+        with self._cond:
+            if stall_ids is None:
+                self._cond.wait_for(lambda: self._seq > since, timeout)
+            else:
+                self._cond.wait_for(
+                    lambda: any(self._latest.get(s, 0) > since for s in stall_ids),
+                    timeout,
+                )
+            return self._seq
+
+    def _collect(self, stall_id, since):
+        if since >= self._seq:
+            return self._seq, []
+        if self._log and self._log[0][0] > since + 1:
+            return self._seq, None
+        seen = []
+        for seq, sid, order_id in self._log:
+            if seq > since and sid == stall_id and order_id and order_id not in seen:
+                seen.append(order_id)
+        return self._seq, seen
@@ -0,0 +1,38 @@
+import gzip
+
+try:
+    import brotli
+except ImportError:     # gzip only
+    brotli = None
+
+# below this a compressed body is barely smaller and costs a header
+MIN_SIZE = 512
+
+
+def encodings():
+    # what we can produce, best first
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def compress(data, encoding):
+    # quality / level picked for speed: these bodies are built per request
+    if encoding == "br":
+        return brotli.compress(data, quality=4)
+    return gzip.compress(data, compresslevel=5, mtime=0)
+
+
+def compress_response(resp, accept_encodings):
+    # Compress a finished Flask response in place when the client accepts
+    # br or gzip. `accept_encodings` is request.accept_encodings.
+    resp.vary.add("Accept-Encoding")
+    if resp.direct_passthrough or resp.is_streamed or "Content-Encoding" in resp.headers:
+        return resp
+    encoding = accept_encodings.best_match(encodings())
+    if not encoding:
+        return resp
+    data = resp.get_data()
+    if len(data) < MIN_SIZE:
+        return resp
+    resp.set_data(compress(data, encoding))
+    resp.headers["Content-Encoding"] = encoding
+    return resp
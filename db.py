@@ -1,10 +1,11 @@
-import sqlite3
+import sqlite3, sys, hashlib
 
-db = sqlite3.connect("database.db")
-db.execute("PRAGMA foreign_keys = ON")
+DATABASE = "database.db"
+
+TABLES = []
 
 # ================= USERS =================
-db.execute("""
+TABLES.append("""
 CREATE TABLE IF NOT EXISTS users (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     username TEXT UNIQUE NOT NULL,
@@ -16,7 +17,7 @@ CREATE TABLE IF NOT EXISTS users (
 """)
 
 # ================= STALLS =================
-db.execute("""
+TABLES.append("""
 CREATE TABLE IF NOT EXISTS stalls (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     owner_id INTEGER NOT NULL,
@@ -27,7 +28,7 @@ CREATE TABLE IF NOT EXISTS stalls (
 """)
 
 # ================= PRODUCTS =================
-db.execute("""
+TABLES.append("""
 CREATE TABLE IF NOT EXISTS products (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     stall_id INTEGER NOT NULL,
@@ -42,7 +43,7 @@ CREATE TABLE IF NOT EXISTS products (
 """)
 
 # ================= ORDERS =================
-db.execute("""
+TABLES.append("""
 CREATE TABLE IF NOT EXISTS orders (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     customer_id INTEGER NOT NULL,
@@ -63,7 +64,7 @@ CREATE TABLE IF NOT EXISTS orders (
 """)
 
 # ================= ORDER ITEMS =================
-db.execute("""
+TABLES.append("""
 CREATE TABLE IF NOT EXISTS order_items (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     order_id INTEGER NOT NULL,
@@ -75,7 +76,7 @@ CREATE TABLE IF NOT EXISTS order_items (
 """)
 
 # ================= REFRESH TOKENS =================
-db.execute("""
+TABLES.append("""
 CREATE TABLE IF NOT EXISTS refresh_tokens (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER NOT NULL,
@@ -87,7 +88,538 @@ CREATE TABLE IF NOT EXISTS refresh_tokens (
 )
 """)
 
-db.commit()
-db.close()
+# ================= MIGRATIONS =================
+# MIGRATIONS[n - 1] upgrades a database from PRAGMA user_version n-1 to n.
+# A step is either a SQL string or a function taking the connection.
+# Never edit a migration that has shipped; append a new one instead.
+MIGRATIONS = []
+
+# 1: secondary indexes for the hot lookups; usernames stored trimmed and
+# lowercased so logins can use the UNIQUE index instead of TRIM(username)
+MIGRATIONS.append([
+    # rows that would collide after normalizing are left as they are
+    "UPDATE OR IGNORE users SET username = LOWER(TRIM(username)) WHERE username <> LOWER(TRIM(username))",
+    "CREATE INDEX IF NOT EXISTS idx_stalls_owner ON stalls(owner_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_products_stall ON products(stall_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_stall ON orders(stall_id, is_deleted, id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_customer ON orders(customer_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_accepted ON orders(stall_id, accepted_at) WHERE status = 'accepted'",
+    "CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id, product_id, quantity)",
+    "CREATE INDEX IF NOT EXISTS idx_order_items_product ON order_items(product_id)",
+    "CREATE INDEX IF NOT EXISTS idx_refresh_tokens_user ON refresh_tokens(user_id)",
+])
+
+
+# 2: per-stall token counter. Tokens can optionally restart every day, so
+# orders gets a token_day column and UNIQUE(stall_id, token_day, token).
+# SQLite can't change a table constraint in place; the table is rebuilt.
+def rebuild_orders_with_token_day(db):
+    seq = db.execute("SELECT seq FROM sqlite_sequence WHERE name='orders'").fetchone()
+    columns = ", ".join(row[1] for row in db.execute("PRAGMA table_info(orders)"))
+
+    db.execute("""
+    CREATE TABLE orders_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        customer_id INTEGER NOT NULL,
+        stall_id INTEGER NOT NULL,
+        price INTEGER,
+        token INTEGER NOT NULL,
+        token_day TEXT NOT NULL DEFAULT '',
+        status TEXT CHECK(
+            status IN ('pending','accepted','rejected','ready','cancelled')
+        ) DEFAULT 'pending',
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        accepted_at DATETIME,
+        prep_time INTEGER,
+        is_deleted INTEGER DEFAULT 0,
+        FOREIGN KEY(customer_id) REFERENCES users(id) ON DELETE RESTRICT,
+        FOREIGN KEY(stall_id) REFERENCES stalls(id) ON DELETE RESTRICT,
+        UNIQUE(stall_id, token_day, token)
+    )
+    """)
+    db.execute("INSERT INTO orders_new (%s) SELECT %s FROM orders" % (columns, columns))
+    db.execute("DROP TABLE orders")
+    db.execute("ALTER TABLE orders_new RENAME TO orders")
+    if seq:
+        db.execute("UPDATE sqlite_sequence SET seq=? WHERE name='orders'", (seq[0],))
+
+MIGRATIONS.append([
+    rebuild_orders_with_token_day,
+    # indexes went away with the old table
+    "CREATE INDEX IF NOT EXISTS idx_orders_stall ON orders(stall_id, is_deleted, id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_customer ON orders(customer_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_accepted ON orders(stall_id, accepted_at) WHERE status = 'accepted'",
+    """
+    CREATE TABLE IF NOT EXISTS stall_sequences (
+        stall_id INTEGER PRIMARY KEY,
+        last_token INTEGER NOT NULL DEFAULT 0,
+        token_day TEXT NOT NULL DEFAULT '',
+        FOREIGN KEY(stall_id) REFERENCES stalls(id) ON DELETE CASCADE
+    )
+    """,
+    """
+    INSERT OR IGNORE INTO stall_sequences (stall_id, last_token)
+    SELECT stall_id, MAX(token) FROM orders GROUP BY stall_id
+    """,
+])
+
+
+# 3: refresh tokens are looked up by a sha256 digest and revoked by
+# stamping revoked_at (logout) instead of deleting the row, so every
+# worker's revocation list can pick the change up
+def hash_refresh_tokens(db):
+    rows = db.execute("SELECT id, token FROM refresh_tokens WHERE token_hash IS NULL").fetchall()
+    db.executemany(
+        "UPDATE refresh_tokens SET token_hash = ? WHERE id = ?",
+        [(hashlib.sha256(token.encode()).hexdigest(), id) for id, token in rows]
+    )
+
+MIGRATIONS.append([
+    "ALTER TABLE refresh_tokens ADD COLUMN token_hash TEXT",
+    "ALTER TABLE refresh_tokens ADD COLUMN revoked_at DATETIME",
+    hash_refresh_tokens,
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_refresh_tokens_hash ON refresh_tokens(token_hash)",
+    "CREATE INDEX IF NOT EXISTS idx_refresh_tokens_sid ON refresh_tokens(sid)",
+    "CREATE INDEX IF NOT EXISTS idx_refresh_tokens_revoked ON refresh_tokens(revoked_at) WHERE revoked_at IS NOT NULL",
+])
+
+
+# 4: drop the raw refresh token. Only its digest is kept (fixed size,
+# unique); expires_at gets an index for the expiry sweep and
+# (user_id, created_at) one for the per-user session cap.
+def rebuild_refresh_tokens_without_token(db):
+    seq = db.execute("SELECT seq FROM sqlite_sequence WHERE name='refresh_tokens'").fetchone()
+
+    db.execute("""
+    CREATE TABLE refresh_tokens_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        token_hash TEXT NOT NULL UNIQUE,
+        sid TEXT NOT NULL,
+        expires_at DATETIME NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        revoked_at DATETIME,
+        FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE RESTRICT
+    )
+    """)
+    db.execute("""
+    INSERT INTO refresh_tokens_new (id, user_id, token_hash, sid, expires_at, created_at, revoked_at)
+    SELECT id, user_id, token_hash, sid, expires_at, created_at, revoked_at FROM refresh_tokens
+    """)
+    db.execute("DROP TABLE refresh_tokens")
+    db.execute("ALTER TABLE refresh_tokens_new RENAME TO refresh_tokens")
+    if seq:
+        db.execute("UPDATE sqlite_sequence SET seq=? WHERE name='refresh_tokens'", (seq[0],))
+
+MIGRATIONS.append([
+    rebuild_refresh_tokens_without_token,
+    # the UNIQUE constraint replaces idx_refresh_tokens_hash
+    "CREATE INDEX IF NOT EXISTS idx_refresh_tokens_user ON refresh_tokens(user_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_refresh_tokens_sid ON refresh_tokens(sid)",
+    "CREATE INDEX IF NOT EXISTS idx_refresh_tokens_revoked ON refresh_tokens(revoked_at) WHERE revoked_at IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_refresh_tokens_expires ON refresh_tokens(expires_at)",
+])
+
+
+# 5: uploaded images are stored by content hash; their pixel size is
+# recorded so pages can reserve the space before the image loads
+MIGRATIONS.append([
+    "ALTER TABLE products ADD COLUMN image_width INTEGER",
+    "ALTER TABLE products ADD COLUMN image_height INTEGER",
+])
+
+
+# 6: order summaries materialized at write time so order lists read one
+# row per order instead of joining order_items and products. The status
+# ranks the two order pages sort by are generated from status.
+MIGRATIONS.append([
+    "ALTER TABLE orders ADD COLUMN total_price INTEGER",
+    "ALTER TABLE orders ADD COLUMN items_summary TEXT",
+    "ALTER TABLE orders ADD COLUMN prep_total INTEGER",
+    """
+    ALTER TABLE orders ADD COLUMN owner_rank INTEGER GENERATED ALWAYS AS (
+        CASE status
+            WHEN 'pending' THEN 1 WHEN 'accepted' THEN 1
+            WHEN 'ready' THEN 2
+            ELSE 3
+        END
+    ) VIRTUAL
+    """,
+    """
+    ALTER TABLE orders ADD COLUMN customer_rank INTEGER GENERATED ALWAYS AS (
+        CASE status
+            WHEN 'accepted' THEN 1 WHEN 'ready' THEN 1
+            WHEN 'pending' THEN 2
+            ELSE 3
+        END
+    ) VIRTUAL
+    """,
+    """
+    UPDATE orders SET
+        total_price = (
+            SELECT SUM(oi.quantity * p.price) FROM order_items oi
+            JOIN products p ON p.id = oi.product_id
+            WHERE oi.order_id = orders.id
+        ),
+        items_summary = (
+            SELECT GROUP_CONCAT(line) FROM (
+                SELECT COALESCE(p.product_name, '[Deleted Product]') || ' x ' || oi.quantity AS line
+                FROM order_items oi
+                LEFT JOIN products p ON p.id = oi.product_id
+                WHERE oi.order_id = orders.id
+                ORDER BY oi.id
+            )
+        ),
+        prep_total = (
+            SELECT SUM(p.prep_time * oi.quantity) FROM order_items oi
+            JOIN products p ON p.id = oi.product_id
+            WHERE oi.order_id = orders.id
+        )
+    """,
+])
+
+
+# 7: finished orders are swept into the archive file by age
+MIGRATIONS.append([
+    "CREATE INDEX IF NOT EXISTS idx_orders_finished ON orders(created_at) WHERE status IN ('ready', 'rejected', 'cancelled')",
+])
+
+
+# 8: change cursor for the JSON API's delta sync. Every insert / update of
+# an order or product takes the next value of the single change_cursor
+# row and stamps it on the row as change_seq; deletes leave a tombstone
+# with that value. Writers are serialized by SQLite, so the cursor only
+# moves forward in commit order and "change_seq > since" never skips a
+# commit. pruned_seq is the newest tombstone already forgotten: a client
+# whose cursor is older than that must take a full snapshot.
+MIGRATIONS.append([
+    """
+    CREATE TABLE IF NOT EXISTS change_cursor (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        seq INTEGER NOT NULL DEFAULT 0,
+        pruned_seq INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    "INSERT OR IGNORE INTO change_cursor (id) VALUES (1)",
+    """
+    CREATE TABLE IF NOT EXISTS deleted_rows (
+        change_seq INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        row_id INTEGER NOT NULL,
+        stall_id INTEGER NOT NULL,
+        customer_id INTEGER,
+        deleted_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "ALTER TABLE orders ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE products ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0",
+    "CREATE INDEX IF NOT EXISTS idx_orders_stall_changes ON orders(stall_id, change_seq)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_customer_changes ON orders(customer_id, change_seq)",
+    "CREATE INDEX IF NOT EXISTS idx_products_stall_changes ON products(stall_id, change_seq)",
+    "CREATE INDEX IF NOT EXISTS idx_deleted_rows_stall ON deleted_rows(stall_id, change_seq)",
+    "CREATE INDEX IF NOT EXISTS idx_deleted_rows_age ON deleted_rows(deleted_at)",
+    """
+    CREATE TRIGGER IF NOT EXISTS orders_changed_insert AFTER INSERT ON orders BEGIN
+        UPDATE change_cursor SET seq = seq + 1 WHERE id = 1;
+        UPDATE orders SET change_seq = (SELECT seq FROM change_cursor WHERE id = 1) WHERE id = NEW.id;
+    END
+    """,
+    # the WHEN skips the trigger's own change_seq update
+    """
+    CREATE TRIGGER IF NOT EXISTS orders_changed_update AFTER UPDATE ON orders
+    WHEN NEW.change_seq = OLD.change_seq BEGIN
+        UPDATE change_cursor SET seq = seq + 1 WHERE id = 1;
+        UPDATE orders SET change_seq = (SELECT seq FROM change_cursor WHERE id = 1) WHERE id = NEW.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS orders_changed_delete AFTER DELETE ON orders BEGIN
+        UPDATE change_cursor SET seq = seq + 1 WHERE id = 1;
+        INSERT INTO deleted_rows (change_seq, kind, row_id, stall_id, customer_id)
+        SELECT seq, 'order', OLD.id, OLD.stall_id, OLD.customer_id FROM change_cursor WHERE id = 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_changed_insert AFTER INSERT ON products BEGIN
+        UPDATE change_cursor SET seq = seq + 1 WHERE id = 1;
+        UPDATE products SET change_seq = (SELECT seq FROM change_cursor WHERE id = 1) WHERE id = NEW.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_changed_update AFTER UPDATE ON products
+    WHEN NEW.change_seq = OLD.change_seq BEGIN
+        UPDATE change_cursor SET seq = seq + 1 WHERE id = 1;
+        UPDATE products SET change_seq = (SELECT seq FROM change_cursor WHERE id = 1) WHERE id = NEW.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_changed_delete AFTER DELETE ON products BEGIN
+        UPDATE change_cursor SET seq = seq + 1 WHERE id = 1;
+        INSERT INTO deleted_rows (change_seq, kind, row_id, stall_id)
+        SELECT seq, 'product', OLD.id, OLD.stall_id FROM change_cursor WHERE id = 1;
+    END
+    """,
+])
+
+
+# 9: sales rollups per stall and hour (and per product and hour), keyed
+# by the hour the order was placed, UTC. Triggers keep them current: an
+# insert counts as placed, the move to ready / rejected / cancelled stamps
+# finished_at and adds the outcome; ready orders add their revenue, prep
+# time (accepted -> ready) and wait time (placed -> ready). Rows already
+# in the database are counted by analytics.SalesRollups.backfill(), which
+# runs once after this migration (sales_rollup_state).
+SALES_OUTCOME = """
+    INSERT INTO sales_hourly (stall_id, hour, completed, rejected, cancelled, revenue,
+                              prep_seconds, prep_count, wait_seconds, wait_count)
+    VALUES (
+        NEW.stall_id, strftime('%Y-%m-%d %H:00', NEW.created_at),
+        NEW.status = 'ready', NEW.status = 'rejected', NEW.status = 'cancelled',
+        CASE WHEN NEW.status = 'ready' THEN COALESCE(NEW.total_price, NEW.price, 0) ELSE 0 END,
+        CASE WHEN NEW.status = 'ready' AND NEW.accepted_at IS NOT NULL AND {finished} IS NOT NULL
+             THEN (julianday({finished}) - julianday(NEW.accepted_at)) * 86400 ELSE 0 END,
+        NEW.status = 'ready' AND NEW.accepted_at IS NOT NULL AND {finished} IS NOT NULL,
+        CASE WHEN NEW.status = 'ready' AND {finished} IS NOT NULL
+             THEN (julianday({finished}) - julianday(NEW.created_at)) * 86400 ELSE 0 END,
+        NEW.status = 'ready' AND {finished} IS NOT NULL
+    )
+    ON CONFLICT(stall_id, hour) DO UPDATE SET
+        completed = completed + excluded.completed,
+        rejected = rejected + excluded.rejected,
+        cancelled = cancelled + excluded.cancelled,
+        revenue = revenue + excluded.revenue,
+        prep_seconds = prep_seconds + excluded.prep_seconds,
+        prep_count = prep_count + excluded.prep_count,
+        wait_seconds = wait_seconds + excluded.wait_seconds,
+        wait_count = wait_count + excluded.wait_count;
+    INSERT INTO product_sales_hourly (stall_id, hour, product_id, quantity, revenue, orders)
+    SELECT NEW.stall_id, strftime('%Y-%m-%d %H:00', NEW.created_at), oi.product_id,
+           SUM(oi.quantity), SUM(oi.quantity * p.price), 1
+    FROM order_items oi JOIN products p ON p.id = oi.product_id
+    WHERE oi.order_id = NEW.id AND NEW.status = 'ready'
+    GROUP BY oi.product_id
+    ON CONFLICT(stall_id, hour, product_id) DO UPDATE SET
+        quantity = quantity + excluded.quantity,
+        revenue = revenue + excluded.revenue,
+        orders = orders + excluded.orders;
+"""
+
+MIGRATIONS.append([
+    "ALTER TABLE orders ADD COLUMN finished_at DATETIME",
+    """
+    CREATE TABLE IF NOT EXISTS sales_hourly (
+        stall_id INTEGER NOT NULL,
+        hour TEXT NOT NULL,
+        placed INTEGER NOT NULL DEFAULT 0,
+        completed INTEGER NOT NULL DEFAULT 0,
+        rejected INTEGER NOT NULL DEFAULT 0,
+        cancelled INTEGER NOT NULL DEFAULT 0,
+        revenue INTEGER NOT NULL DEFAULT 0,
+        prep_seconds REAL NOT NULL DEFAULT 0,
+        prep_count INTEGER NOT NULL DEFAULT 0,
+        wait_seconds REAL NOT NULL DEFAULT 0,
+        wait_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (stall_id, hour)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS product_sales_hourly (
+        stall_id INTEGER NOT NULL,
+        hour TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL DEFAULT 0,
+        revenue INTEGER NOT NULL DEFAULT 0,
+        orders INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (stall_id, hour, product_id)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sales_rollup_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        backfilled_at DATETIME
+    )
+    """,
+    "INSERT OR IGNORE INTO sales_rollup_state (id) VALUES (1)",
+    """
+    CREATE TRIGGER IF NOT EXISTS sales_order_placed AFTER INSERT ON orders BEGIN
+        INSERT INTO sales_hourly (stall_id, hour, placed)
+        VALUES (NEW.stall_id, strftime('%Y-%m-%d %H:00', NEW.created_at), 1)
+        ON CONFLICT(stall_id, hour) DO UPDATE SET placed = placed + 1;
+    END
+    """,
+    # orders written already finished (imports) count without prep / wait
+    """
+    CREATE TRIGGER IF NOT EXISTS sales_order_inserted_finished AFTER INSERT ON orders
+    WHEN NEW.status IN ('ready', 'rejected', 'cancelled') BEGIN
+    """ + SALES_OUTCOME.format(finished="NEW.finished_at") + """
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS sales_order_finished AFTER UPDATE OF status ON orders
+    WHEN NEW.status <> OLD.status AND NEW.status IN ('ready', 'rejected', 'cancelled')
+    AND OLD.status NOT IN ('ready', 'rejected', 'cancelled') BEGIN
+        UPDATE orders SET finished_at = strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE id = NEW.id;
+    """ + SALES_OUTCOME.format(finished="strftime('%Y-%m-%d %H:%M:%f', 'now')") + """
+    END
+    """,
+])
+
+
+
+# 10: the order pages list every open (pending / accepted) order on the
+# first page however old it is; these keep that lookup to the open rows
+MIGRATIONS.append([
+    "CREATE INDEX IF NOT EXISTS idx_orders_stall_open ON orders(stall_id, is_deleted) WHERE status IN ('pending', 'accepted')",
+    "CREATE INDEX IF NOT EXISTS idx_orders_customer_open ON orders(customer_id) WHERE status IN ('pending', 'accepted')",
+])
+
+
+def schema_version(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db):
+    # BEGIN IMMEDIATE: when several workers start at once, one migrates and
+    # the others wait for the lock and then find nothing left to do
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        version = schema_version(db)
+        for number in range(version + 1, len(MIGRATIONS) + 1):
+            for step in MIGRATIONS[number - 1]:
+                if callable(step):
+                    step(db)
+                else:
+                    db.execute(step)
+            db.execute("PRAGMA user_version = %d" % number)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return version, schema_version(db)
+
+
+def init_db(path=DATABASE):
+    db = sqlite3.connect(path, timeout=30)
+    try:
+        for sql in TABLES:
+            db.execute(sql)
+        db.commit()
+        return migrate(db)
+    finally:
+        db.close()
+
+
+# ================= QUERY PLANS =================
+# (name, sql, params, indexes the plan must use)
+HOT_QUERIES = [
+    ("current token",
+     "SELECT last_token, token_day FROM stall_sequences WHERE stall_id=?",
+     (1,), ["INTEGER PRIMARY KEY"]),
+    ("first token of the day",
+     "SELECT COALESCE(MAX(token), 0) + 1 FROM orders WHERE stall_id=? AND token_day=?",
+     (1, ""), ["sqlite_autoindex_orders_1"]),
+    ("login",
+     "SELECT * FROM users WHERE username = ?",
+     ("a",), ["sqlite_autoindex_users_1"]),
+    ("stall by owner",
+     "SELECT id, stall_name FROM stalls WHERE owner_id=?",
+     (1,), ["idx_stalls_owner"]),
+    ("stall menu",
+     "SELECT id, product_name, price, prep_time, availability, image FROM products WHERE stall_id=? ORDER BY id ASC",
+     (1,), ["idx_products_stall"]),
+    ("owner orders page",
+     "SELECT o.* FROM orders o JOIN stalls s ON o.stall_id = s.id WHERE s.owner_id = ? AND o.is_deleted = 0 AND o.status NOT IN ('pending', 'accepted') AND o.id < ? ORDER BY o.id DESC LIMIT 50",
+     (1, 100), ["idx_stalls_owner", "idx_orders_stall"]),
+    ("owner open orders",
+     "SELECT o.* FROM orders o JOIN stalls s ON o.stall_id = s.id WHERE s.owner_id = ? AND o.is_deleted = 0 AND o.status IN ('pending', 'accepted')",
+     (1,), ["idx_stalls_owner", "idx_orders_stall_open"]),
+    ("customer orders page",
+     "SELECT o.* FROM orders o WHERE o.customer_id = ? AND o.status NOT IN ('pending', 'accepted') AND o.id < ? ORDER BY o.id DESC LIMIT 50",
+     (1, 100), ["idx_orders_customer"]),
+    ("customer open orders",
+     "SELECT o.* FROM orders o WHERE o.customer_id = ? AND o.status IN ('pending', 'accepted')",
+     (1,), ["idx_orders_customer_open"]),
+    ("stall accepted orders",
+     "SELECT id FROM orders WHERE stall_id=? AND status='accepted' AND is_deleted=0",
+     (1,), ["idx_orders_stall"]),
+    ("ready sweep",
+     "SELECT id, accepted_at, prep_time FROM orders WHERE status = 'accepted'",
+     (), ["idx_orders_accepted"]),
+    ("order items",
+     "SELECT oi.order_id, oi.quantity FROM order_items oi WHERE oi.order_id IN (?, ?)",
+     (1, 2), ["idx_order_items_order"]),
+    ("refresh token",
+     "SELECT u.id, u.username, u.role FROM refresh_tokens rt JOIN users u ON u.id = rt.user_id "
+     "WHERE rt.token_hash = ? AND rt.user_id = ? AND rt.revoked_at IS NULL",
+     ("t", 1), ["sqlite_autoindex_refresh_tokens_1"]),
+    ("revoked sessions",
+     "SELECT sid, revoked_at FROM refresh_tokens WHERE revoked_at > ?",
+     ("",), ["idx_refresh_tokens_revoked"]),
+    ("session revoked",
+     "SELECT 1 FROM refresh_tokens WHERE sid = ? AND revoked_at IS NOT NULL",
+     ("s",), ["idx_refresh_tokens_sid"]),
+    ("archive sweep",
+     "SELECT id FROM main.orders WHERE status IN ('ready', 'rejected', 'cancelled') AND created_at < ? LIMIT 500",
+     ("",), ["idx_orders_finished"]),
+    ("expired sessions",
+     "SELECT id FROM refresh_tokens WHERE expires_at < ? LIMIT 500",
+     ("",), ["idx_refresh_tokens_expires"]),
+    ("owner order changes",
+     "SELECT id FROM orders WHERE stall_id = ? AND change_seq > ?",
+     (1, 100), ["idx_orders_stall_changes"]),
+    ("customer order changes",
+     "SELECT id FROM orders WHERE customer_id = ? AND change_seq > ?",
+     (1, 100), ["idx_orders_customer_changes"]),
+    ("menu changes",
+     "SELECT id, product_name, price FROM products WHERE stall_id = ? AND change_seq > ? ORDER BY id",
+     (1, 100), ["idx_products_stall_changes"]),
+    ("deleted since",
+     "SELECT row_id FROM deleted_rows WHERE stall_id = ? AND change_seq > ? AND kind = ?",
+     (1, 100, "order"), ["idx_deleted_rows_stall"]),
+    ("sales summary",
+     "SELECT SUM(placed), SUM(revenue) FROM sales_hourly WHERE stall_id = ? AND hour >= ? AND hour < ?",
+     (1, "", "~"), ["PRIMARY KEY"]),
+    ("product sales",
+     "SELECT product_id, SUM(quantity) FROM product_sales_hourly WHERE stall_id = ? AND hour >= ? AND hour < ? GROUP BY product_id",
+     (1, "", "~"), ["PRIMARY KEY"]),
+    ("sessions of user",
+     "SELECT id, sid FROM refresh_tokens WHERE user_id = ? AND revoked_at IS NULL ORDER BY created_at DESC",
+     (1,), ["idx_refresh_tokens_user"]),
+]
+
+
+def explain(db, sql, params=()):
+    return [row[3] for row in db.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+def check_query_plans(db):
+    # raises AssertionError naming the first hot query that would table-scan
+    for name, sql, params, indexes in HOT_QUERIES:
+        plan = explain(db, sql, params)
+        text = " | ".join(plan)
+        for detail in plan:
+            if detail.startswith("SCAN") and "INDEX" not in detail:
+                raise AssertionError("%s: full scan (%s)" % (name, text))
+        for index in indexes:
+            if index not in text:
+                raise AssertionError("%s: expected %s (%s)" % (name, index, text))
+    return True
+
+
+if __name__ == "__main__":
+    path = DATABASE
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    if args:
+        path = args[0]
+
+    old, new = init_db(path)
+    print("Database.db is created")
+    print("Schema version %d -> %d" % (old, new))
 
-print("Database.db is created")
+    if "--check" in sys.argv:
+        db = sqlite3.connect(path)
+        for name, sql, params, _ in HOT_QUERIES:
+            print("%-22s %s" % (name, " | ".join(explain(db, sql, params))))
+        check_query_plans(db)
+        db.close()
+        print("Query plans OK")
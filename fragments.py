@@ -0,0 +1,59 @@
+import threading
+from collections import OrderedDict
+from markupsafe import Markup
+
+
+class FragmentCache:
+    # Rendered HTML of small templates that repeat down a page (a product
+    # card, an order row), kept in an LRU. The key is everything the
+    # fragment shows, e.g. (order_id, status, ...the other fields), so a
+    # changed row simply misses and renders under its new key; nothing has
+    # to be invalidated and old entries age out. A page of 50 rows where
+    # one changed renders one template instead of 50.
+
+    def __init__(self, env, maxsize=4096):
+        self.env = env
+        self.maxsize = maxsize
+        self._data = OrderedDict()     # (template, key) -> Markup
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "precompiled": 0}
+
+    def precompile(self):
+        # compile every template now, so the first request of each page
+        # doesn't pay for it; with gunicorn --preload this happens once
+        names = self.env.list_templates(extensions=["html"])
+        for name in names:
+            self.env.get_template(name)
+        with self._lock:
+            self._stats["precompiled"] = len(names)
+        return len(names)
+
+    def render(self, name, key, **context):
+        with self._lock:
+            html = self._data.get((name, key))
+            if html is not None:
+                self._data.move_to_end((name, key))
+                self._stats["hits"] += 1
+                return html
+            self._stats["misses"] += 1
+
+        html = Markup(self.env.get_template(name).render(**context))
+
+        with self._lock:
+            self._data[(name, key)] = html
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats["evictions"] += 1
+        return html
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["size"] = len(self._data)
+        lookups = data["hits"] + data["misses"]
+        data["hit_ratio"] = round(data["hits"] / lookups, 3) if lookups else None
+        return data
@@ -0,0 +1,182 @@
+import hashlib, io, os, re, sys, threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:     # uploads still work, just without thumbnails/sizes
+    Image = None
+
+EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".gif"}
+
+# content-addressed names never change meaning, so they may be cached forever
+HASHED = re.compile(r"^[0-9a-f]{32}(-\d+)?\.[a-z]+$")
+
+
+class BadImage(ValueError):
+    pass
+
+
+def is_hashed(name):
+    return bool(HASHED.match(os.path.basename(name)))
+
+
+class ImageStore:
+    # Uploads are stored as <sha256[:32]><ext>, so the same picture uploaded
+    # twice is one file and two products with the same filename no longer
+    # overwrite each other. WebP thumbnails (one per width in `sizes`) are
+    # written to thumbs/ by a small thread pool; until one exists the
+    # original is served.
+
+    def __init__(self, root, sizes=(160, 480), workers=2):
+        self.root = root
+        self.sizes = tuple(sizes)
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._pending = set()
+        self._ready = set()             # thumbnails known to exist
+        self._stats = {"uploads": 0, "deduped": 0, "thumbs": 0, "thumb_errors": 0}
+
+    def _pool(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="thumbs")
+                    self._pending = set()
+                    self._pid = os.getpid()
+        return self._executor
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def thumb_name(self, name, size):
+        return "thumbs/%s-%d.webp" % (os.path.splitext(name)[0], size)
+
+    def save(self, upload):
+        # (name, width, height) for a werkzeug FileStorage; raises BadImage
+        ext = os.path.splitext(upload.filename or "")[1].lower()
+        if ext not in EXTENSIONS:
+            raise BadImage("Unsupported image type")
+        data = upload.read()
+        width = height = None
+        if Image is not None:
+            try:
+                with Image.open(io.BytesIO(data)) as img:
+                    width, height = img.size
+                    img.verify()
+            except Exception:
+                raise BadImage("Not a valid image")
+
+        name = hashlib.sha256(data).hexdigest()[:32] + ext
+        path = self.path(name)
+        with self._lock:
+            self._stats["uploads"] += 1
+        if os.path.exists(path):
+            with self._lock:
+                self._stats["deduped"] += 1
+        else:
+            os.makedirs(self.root, exist_ok=True)
+            tmp = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        self.make_thumbs(name)
+        return name, width, height
+
+    def make_thumbs(self, name):
+        if Image is None:
+            return
+        with self._lock:
+            if name in self._pending:
+                return
+            self._pending.add(name)
+        self._pool().submit(self._thumbs, name)
+
+    def _thumbs(self, name):
+        try:
+            os.makedirs(os.path.join(self.root, "thumbs"), exist_ok=True)
+            with Image.open(self.path(name)) as img:
+                img.load()
+                for size in self.sizes:
+                    out = self.path(self.thumb_name(name, size))
+                    if os.path.exists(out):
+                        continue
+                    thumb = img.copy()
+                    thumb.thumbnail((size, size * 4))
+                    if thumb.mode not in ("RGB", "RGBA"):
+                        thumb = thumb.convert("RGBA")
+                    tmp = "%s.%d.tmp" % (out, os.getpid())
+                    thumb.save(tmp, "WEBP", quality=80, method=4)
+                    os.replace(tmp, out)
+                    with self._lock:
+                        self._stats["thumbs"] += 1
+        except Exception:
+            with self._lock:
+                self._stats["thumb_errors"] += 1
+        finally:
+            with self._lock:
+                self._pending.discard(name)
+
+    def best(self, name, width):
+        # smallest thumbnail at least `width` px wide, else the original;
+        # a missing thumbnail is queued so the next page gets it
+        size = next((s for s in self.sizes if s >= width), None)
+        if size is None:
+            return name
+        thumb = self.thumb_name(name, size)
+        if thumb in self._ready:
+            return thumb
+        if os.path.exists(self.path(thumb)):
+            self._ready.add(thumb)
+            return thumb
+        if os.path.exists(self.path(name)):
+            self.make_thumbs(name)
+        return name
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["pending"] = len(self._pending)
+        return data
+
+
+def rehash_uploads(db, store):
+    # one-off: rename files saved under their original name to content
+    # hashes and record their sizes. Returns the number of products updated.
+    class Upload:
+        def __init__(self, path):
+            self.filename = path
+            self._path = path
+
+        def read(self):
+            with open(self._path, "rb") as f:
+                return f.read()
+
+    updated = 0
+    rows = db.execute("SELECT id, image FROM products WHERE image IS NOT NULL AND image <> ''").fetchall()
+    for product_id, image in rows:
+        path = store.path(image)
+        if is_hashed(image) or not os.path.exists(path):
+            continue
+        try:
+            name, width, height = store.save(Upload(path))
+        except BadImage:
+            continue
+        db.execute(
+            "UPDATE products SET image = ?, image_width = ?, image_height = ? WHERE id = ?",
+            (name, width, height, product_id)
+        )
+        updated += 1
+    db.commit()
+    return updated
+
+
+if __name__ == "__main__":
+    import sqlite3
+    path = sys.argv[1] if len(sys.argv) > 1 else "database.db"
+    store = ImageStore("static/uploads", workers=1)
+    db = sqlite3.connect(path)
+    print("Products updated: %d" % rehash_uploads(db, store))
+    db.close()
+    store._pool().shutdown(wait=True)
@@ -0,0 +1,203 @@
+import re, threading, time, os
+from collections import Counter, deque
+
+# seconds; Prometheus "le" bucket bounds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    # the statement shape without its values, so `WHERE id = 7` and
+    # `WHERE id = 8` (or IN lists of any length) count as the same query
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = _LIST.sub("(...)", sql)
+    return _SPACE.sub(" ", sql).strip()[:200]
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (n, _label(v)) for n, v in zip(names, values))
+
+
+class Histogram:
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}       # label values -> [count per bucket..., sum, count]
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def lines(self):
+        yield "# HELP %s %s" % (self.name, self.help)
+        yield "# TYPE %s histogram" % self.name
+        for labels, series in sorted(self._series.items()):
+            for bound, count in zip(self.buckets, series):
+                yield "%s_bucket%s %d" % (self.name, _labels(self.labels + ("le",), labels + (repr(bound),)), count)
+            yield "%s_bucket%s %d" % (self.name, _labels(self.labels + ("le",), labels + ("+Inf",)), series[-1])
+            yield "%s_sum%s %.6f" % (self.name, _labels(self.labels, labels), series[-2])
+            yield "%s_count%s %d" % (self.name, _labels(self.labels, labels), series[-1])
+
+
+class Counters:
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = Counter()
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] += amount
+
+    def lines(self):
+        yield "# HELP %s %s" % (self.name, self.help)
+        yield "# TYPE %s counter" % self.name
+        for labels, value in sorted(self._values.items()):
+            yield "%s%s %s" % (self.name, _labels(self.labels, labels), value)
+
+
+class RequestStats:
+    # what one request did; filled in by the trace / timing callbacks
+
+    __slots__ = ("started", "statements", "sql_seconds", "shapes", "slow")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.shapes = Counter()
+        self.slow = []
+
+
+class Metrics:
+    # Per-worker request metrics, rendered in the Prometheus text format.
+    # Every request gets a RequestStats; its get_db() connection reports
+    # each statement SQLite runs (sqlite3 trace callback) and the time
+    # spent in execute(). When the request ends:
+    #   - the latency, statement count and SQL time land in per-endpoint
+    #     histograms
+    #   - a statement slower than `slow_ms` counts as a slow query
+    #   - the same statement shape run `repeat` or more times in one
+    #     request counts as an N+1 for that endpoint
+    # The last `keep` slow queries and N+1s are kept for /health/sql.
+
+    def __init__(self, slow_ms=50, repeat=10, keep=50):
+        self.slow_ms = slow_ms
+        self.repeat = repeat
+        self._lock = threading.Lock()
+        self._recent_slow = deque(maxlen=keep)
+        self._recent_repeats = deque(maxlen=keep)
+        self.latency = Histogram(
+            "takego_request_seconds", "Time to build the response, by endpoint",
+            ("endpoint", "method"))
+        self.requests = Counters(
+            "takego_requests_total", "Responses by endpoint and status",
+            ("endpoint", "method", "status"))
+        self.sql_statements = Histogram(
+            "takego_request_sql_statements", "SQL statements run per request on the request connection",
+            ("endpoint",), COUNT_BUCKETS)
+        self.sql_time = Histogram(
+            "takego_request_sql_seconds", "Time spent in execute() per request on the request connection",
+            ("endpoint",))
+        self.slow = Counters(
+            "takego_sql_slow_total", "Statements slower than the slow query threshold",
+            ("endpoint",))
+        self.repeats = Counters(
+            "takego_sql_repeated_total", "Requests that ran one statement shape repeatedly (likely N+1)",
+            ("endpoint", "statement"))
+        self.render = Histogram(
+            "takego_template_render_seconds", "Jinja render time",
+            ("template",))
+
+    # ---------- per request ----------
+
+    def begin(self):
+        return RequestStats()
+
+    def tracer(self, stats):
+        # sqlite3 trace callback: called with every statement as it starts
+        def trace(sql):
+            stats.statements += 1
+            stats.shapes[normalize_sql(sql)] += 1
+        return trace
+
+    def timer(self, stats):
+        # PooledConnection.on_execute callback
+        def timed(sql, seconds):
+            stats.sql_seconds += seconds
+            if seconds * 1000 >= self.slow_ms:
+                stats.slow.append((normalize_sql(sql), seconds))
+        return timed
+
+    def finish(self, stats, endpoint, method, status):
+        elapsed = time.perf_counter() - stats.started
+        endpoint = endpoint or "unmatched"
+        repeated = [(shape, n) for shape, n in stats.shapes.items() if n >= self.repeat]
+        with self._lock:
+            self.latency.observe(elapsed, endpoint, method)
+            self.requests.inc(endpoint, method, str(status))
+            self.sql_statements.observe(stats.statements, endpoint)
+            self.sql_time.observe(stats.sql_seconds, endpoint)
+            for shape, seconds in stats.slow:
+                self.slow.inc(endpoint)
+                self._recent_slow.append({"endpoint": endpoint, "sql": shape, "ms": round(seconds * 1000, 2)})
+            for shape, n in repeated:
+                self.repeats.inc(endpoint, shape)
+                self._recent_repeats.append({"endpoint": endpoint, "sql": shape, "times": n})
+        return elapsed
+
+    def rendered(self, template, seconds):
+        with self._lock:
+            self.render.observe(seconds, template or "<string>")
+
+    # ---------- output ----------
+
+    def text(self, gauges=None):
+        # `gauges`: {"db_pool": pool.stats(), ...}; numeric values become
+        # takego_<group>_<key> gauges
+        lines = []
+        with self._lock:
+            for metric in (self.latency, self.requests, self.sql_statements, self.sql_time,
+                           self.slow, self.repeats, self.render):
+                lines.extend(metric.lines())
+        for group, values in sorted((gauges or {}).items()):
+            for key, value in sorted(values.items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = "takego_%s_%s" % (group, re.sub(r"[^a-zA-Z0-9_]", "_", key))
+                lines.append("# TYPE %s gauge" % name)
+                lines.append("%s %s" % (name, value))
+        lines.append("# TYPE takego_worker_pid gauge")
+        lines.append("takego_worker_pid %d" % os.getpid())
+        return "\n".join(lines) + "\n"
+
+    def stats(self):
+        with self._lock:
+            return {
+                "slow_ms": self.slow_ms,
+                "repeat": self.repeat,
+                "slow": list(self._recent_slow),
+                "repeated": list(self._recent_repeats),
+            }
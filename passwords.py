@@ -0,0 +1,118 @@
+import multiprocessing, os, threading, time
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HasherBusy(Exception):
+    pass
+
+
+def method_tag(hashed):
+    # "scrypt:32768:8:1$salt$hash" -> "scrypt:32768:8:1"
+    return hashed.split("$", 1)[0]
+
+
+# these run in the worker processes
+
+def _hash(method, password):
+    return generate_password_hash(password, method=method)
+
+
+def _verify(method, tag, password, hashed):
+    if not check_password_hash(hashed, password):
+        return False, None
+    if method_tag(hashed) != tag:
+        # cost or algorithm changed since this hash was made
+        return True, generate_password_hash(password, method=method)
+    return True, None
+
+
+def _exit_with_parent(parent):
+    # pool processes must not outlive the server worker that started them,
+    # which may exit without shutting its pool down
+    def watch():
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+
+class PasswordHasher:
+    # Runs the KDF in a small process pool so a burst of logins does not hold
+    # the request threads for tens of milliseconds each. At most `max_pending`
+    # hashes may be queued or running; past that hash()/verify() raise
+    # HasherBusy and the route answers 503. workers=0 hashes inline.
+    #
+    # The pool is created lazily per process, so gunicorn workers forked
+    # from a preloaded app each get their own.
+
+    def __init__(self, method="scrypt", workers=2, max_pending=32, timeout=10):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._pid = None
+        self._tag = None
+        self._stats = {"hashes": 0, "verifies": 0, "rehashes": 0, "rejected": 0}
+
+    @property
+    def tag(self):
+        # the exact prefix werkzeug writes for `method`, with defaults filled in
+        if self._tag is None:
+            self._tag = method_tag(_hash(self.method, ""))
+        return self._tag
+
+    def _pool(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # spawned, not forked: a forked child would inherit the
+                    # server's listening socket and signal handlers and could
+                    # outlive its worker still holding the port
+                    self._executor = ProcessPoolExecutor(
+                        self.workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                        initializer=_exit_with_parent,
+                        initargs=(os.getpid(),),
+                    )
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats["rejected"] += 1
+            raise HasherBusy()
+        try:
+            if not self.workers:
+                return fn(*args)
+            return self._pool().submit(fn, *args).result(self.timeout)
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        result = self._run(_hash, self.method, password)
+        with self._lock:
+            self._stats["hashes"] += 1
+        return result
+
+    def verify(self, password, hashed):
+        # (matches, new_hash); new_hash is set when the stored hash should be
+        # replaced because the configured method or cost changed
+        ok, new_hash = self._run(_verify, self.method, self.tag, password, hashed)
+        with self._lock:
+            self._stats["verifies"] += 1
+            if new_hash:
+                self._stats["rehashes"] += 1
+        return ok, new_hash
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+        data["method"] = self.tag
+        data["workers"] = self.workers
+        data["max_pending"] = self.max_pending
+        return data
@@ -0,0 +1,188 @@
+import sqlite3, threading, queue, time, weakref, os
+from contextlib import contextmanager
+
+# applied once when a connection is opened, not on every checkout
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=10000",
+    "PRAGMA mmap_size=268435456",   # 256 MB
+    "PRAGMA cache_size=-16000",     # ~16 MB
+)
+
+
+class PoolExhausted(sqlite3.OperationalError):
+    pass
+
+
+class PooledConnection(sqlite3.Connection):
+    # close() hands the connection back to its pool instead of closing it.
+    # While bound to a Flask app context, close() is a no-op and the
+    # teardown handler releases it.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = None
+        self.bound = False
+        self.state = {"out": False, "since": 0.0}
+        # on_execute(sql, seconds) after each execute() while set; the time
+        # covers SQLite's first step, not rows fetched later
+        self.on_execute = None
+
+    def execute(self, sql, *args):
+        if self.on_execute is None:
+            return super().execute(sql, *args)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            self.on_execute(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, *args):
+        if self.on_execute is None:
+            return super().executemany(sql, *args)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            self.on_execute(sql, time.perf_counter() - started)
+
+    def close(self):
+        if self.pool is None:
+            return super().close()
+        if self.bound:
+            return
+        self.pool.release(self)
+
+
+class ConnectionPool:
+
+    def __init__(self, path, size=8, timeout=10, leak_seconds=30):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.leak_seconds = leak_seconds
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()   # LIFO keeps the warmest connection in use
+        self._created = 0
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_ms": 0.0,
+            "timeouts": 0,
+            "leaks": 0,
+            "rollbacks": 0,
+            "long_held": 0,
+        }
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            check_same_thread=False,
+            factory=PooledConnection,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        conn.pool = self
+        weakref.finalize(conn, self._collected, conn.state)
+        return conn
+
+    def _collected(self, state):
+        # a checked-out connection was garbage collected without release()
+        if state["out"]:
+            with self._lock:
+                self._stats["leaks"] += 1
+                self._created -= 1
+
+    def acquire(self):
+        # gunicorn forks workers after import; never share handles with the parent
+        if os.getpid() != self.pid:
+            with self._lock:
+                if os.getpid() != self.pid:
+                    self._reset()
+
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    create = True
+                else:
+                    create = False
+                    self._stats["waits"] += 1
+
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                started = time.monotonic()
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._stats["timeouts"] += 1
+                    raise PoolExhausted("connection pool exhausted")
+                with self._lock:
+                    self._stats["wait_ms"] += (time.monotonic() - started) * 1000
+
+        conn.state["out"] = True
+        conn.state["since"] = time.monotonic()
+        with self._lock:
+            self._stats["checkouts"] += 1
+        return conn
+
+    def release(self, conn):
+        if not conn.state["out"]:
+            return
+        if conn.in_transaction:
+            # caller forgot to commit / rollback
+            conn.rollback()
+            with self._lock:
+                self._stats["rollbacks"] += 1
+        held = time.monotonic() - conn.state["since"]
+        conn.state["out"] = False
+        if held > self.leak_seconds:
+            with self._lock:
+                self._stats["long_held"] += 1
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["size"] = self.size
+            data["open"] = self._created
+        data["idle"] = self._idle.qsize()
+        data["in_use"] = data["open"] - data["idle"]
+        data["wait_ms"] = round(data["wait_ms"], 2)
+        return data
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.pool = None
+            conn.close()
+            with self._lock:
+                self._created -= 1
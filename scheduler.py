@@ -0,0 +1,228 @@
+import threading, heapq, math, os
+from datetime import datetime, timedelta, timezone
+
+
+def parse_time(value):
+    t = datetime.fromisoformat(value)
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=timezone.utc)
+    return t
+
+
+class ReadyScheduler:
+    # Keeps every accepted order of this worker in a per-stall ETA queue and
+    # a min-heap of (ready_at, order_id). A background thread flips due
+    # orders to 'ready' with one UPDATE. Each worker tracks the orders it
+    # accepted or loaded; the UPDATE only touches rows still 'accepted', so
+    # two workers flipping the same order is harmless.
+
+    def __init__(self, pool, on_ready=None):
+        self.pool = pool
+        self.on_ready = on_ready        # fn(stall_id, order_ids, customer_ids)
+        self._cond = threading.Condition()
+        self._heap = []                 # (ready_at, order_id)
+        self._queues = {}               # stall_id -> [(accepted_at, order_id, prep)]
+        self._ready_at = {}             # order_id -> ready_at
+        self._stall_of = {}             # order_id -> stall_id
+        self._pid = None
+
+    # ---------- queue maintenance ----------
+
+    def _recompute(self, stall_id):
+        # same rule the order pages always used: an order is ready after the
+        # prep time of itself and every order accepted before it
+        queue = self._queues.get(stall_id, [])
+        queue.sort()
+        cumulative = 0
+        for accepted_at, order_id, prep in queue:
+            cumulative += prep
+            ready_at = accepted_at + timedelta(minutes=cumulative)
+            if self._ready_at.get(order_id) != ready_at:
+                self._ready_at[order_id] = ready_at
+                heapq.heappush(self._heap, (ready_at, order_id))
+        if not queue:
+            self._queues.pop(stall_id, None)
+
+    def _drop(self, order_id):
+        stall_id = self._stall_of.pop(order_id, None)
+        self._ready_at.pop(order_id, None)
+        if stall_id is None:
+            return None
+        self._queues[stall_id] = [
+            entry for entry in self._queues.get(stall_id, []) if entry[1] != order_id
+        ]
+        return stall_id
+
+    def _add(self, stall_id, order_id, accepted_at, prep):
+        self._drop(order_id)
+        self._stall_of[order_id] = stall_id
+        self._queues.setdefault(stall_id, []).append(
+            (parse_time(accepted_at), order_id, int(prep or 0))
+        )
+
+    def accepted(self, stall_id, order_id, accepted_at, prep):
+        with self._cond:
+            self._add(stall_id, order_id, accepted_at, prep)
+            self._recompute(stall_id)
+            self._cond.notify()
+
+    def discard(self, order_id):
+        with self._cond:
+            stall_id = self._drop(order_id)
+            if stall_id is not None:
+                self._recompute(stall_id)
+
+    def _load(self, db, stall_id=None):
+        sql = """
+            SELECT o.id, o.stall_id, o.accepted_at,
+                   COALESCE(o.prep_time, o.prep_total, 0) AS prep
+            FROM orders o
+            WHERE o.status = 'accepted' AND o.accepted_at IS NOT NULL
+        """
+        params = ()
+        if stall_id is not None:
+            sql += " AND o.stall_id = ?"
+            params = (stall_id,)
+        return db.execute(sql, params).fetchall()
+
+    def rebuild(self, db):
+        rows = self._load(db)
+        with self._cond:
+            self._heap = []
+            self._queues = {}
+            self._ready_at = {}
+            self._stall_of = {}
+            for row in rows:
+                self._add(row["stall_id"], row["id"], row["accepted_at"], row["prep"])
+            for stall_id in list(self._queues):
+                self._recompute(stall_id)
+            self._cond.notify()
+
+    def reload_stall(self, db, stall_id):
+        rows = self._load(db, stall_id)
+        with self._cond:
+            for accepted_at, order_id, prep in self._queues.get(stall_id, []):
+                self._stall_of.pop(order_id, None)
+                self._ready_at.pop(order_id, None)
+            self._queues.pop(stall_id, None)
+            for row in rows:
+                self._add(stall_id, row["id"], row["accepted_at"], row["prep"])
+            self._recompute(stall_id)
+            self._cond.notify()
+
+    # ---------- readers ----------
+
+    def annotate(self, orders, db=None):
+        # adds ready_at / remaining to order rows (they need id, stall_id,
+        # status, accepted_at). Accepted orders come first in queue order,
+        # like the old apply_eta_queue.
+        now = datetime.now(timezone.utc)
+        accepted = [o for o in orders if o["status"] == "accepted" and o["accepted_at"]]
+
+        if db is not None:
+            # accepted by another worker: pick up that stall's queue
+            unknown = {o["stall_id"] for o in accepted if o["id"] not in self._ready_at}
+            for stall_id in unknown:
+                self.reload_stall(db, stall_id)
+
+        final = []
+        with self._cond:
+            ready = {o["id"]: self._ready_at.get(o["id"]) for o in accepted}
+
+        accepted.sort(key=lambda o: o["accepted_at"])
+        for o in accepted:
+            o = dict(o)
+            ready_at = ready[o["id"]]
+            if ready_at is None:
+                o["ready_at"] = None
+                o["remaining"] = None
+            else:
+                o["ready_at"] = ready_at.isoformat()
+                o["remaining"] = max(0, math.ceil((ready_at - now).total_seconds() / 60))
+            final.append(o)
+
+        for o in orders:
+            if o["status"] != "accepted":
+                o = dict(o)
+                o["remaining"] = None
+                o["ready_at"] = None
+                final.append(o)
+
+        return final
+
+    def stats(self):
+        with self._cond:
+            return {
+                "accepted": len(self._ready_at),
+                "stalls": len(self._queues),
+                "heap": len(self._heap),
+            }
+
+    # ---------- background flipping ----------
+
+    def ensure_started(self):
+        # start (or restart after a fork) the flip thread in this process
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        with self.pool.connection() as db:
+            self.rebuild(db)
+        threading.Thread(target=self._run, name="ready-scheduler", daemon=True).start()
+
+    def _due(self):
+        now = datetime.now(timezone.utc)
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            ready_at, order_id = heapq.heappop(self._heap)
+            # entries go stale when a stall's queue is recomputed
+            if self._ready_at.get(order_id) == ready_at:
+                due.append(order_id)
+        return due
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = self._due()
+                if not due:
+                    timeout = 60
+                    if self._heap:
+                        wait = (self._heap[0][0] - datetime.now(timezone.utc)).total_seconds()
+                        timeout = min(timeout, max(wait, 0.05))
+                    self._cond.wait(timeout)
+                    continue
+            try:
+                self.flip(due)
+            except Exception:
+                # database busy etc.: put them back and try again shortly
+                with self._cond:
+                    retry = datetime.now(timezone.utc) + timedelta(seconds=5)
+                    for order_id in due:
+                        if order_id in self._ready_at:
+                            self._ready_at[order_id] = retry
+                            heapq.heappush(self._heap, (retry, order_id))
+                    self._cond.wait(1)
+
+    def flip(self, order_ids):
+        with self.pool.connection() as db:
+            rows = db.execute("""
+                UPDATE orders SET status = 'ready'
+                WHERE status = 'accepted'
+                AND id IN (%s)
+                RETURNING id, stall_id, customer_id
+            """ % ",".join("?" * len(order_ids)), order_ids).fetchall()
+            db.commit()
+
+        by_stall = {}
+        for order_id, stall_id, customer_id in rows:
+            ids, customers = by_stall.setdefault(stall_id, ([], []))
+            ids.append(order_id)
+            customers.append(customer_id)
+        for order_id in order_ids:
+            self.discard(order_id)
+        if self.on_ready:
+            for stall_id, (ids, customers) in by_stall.items():
+                self.on_ready(stall_id, ids, customers)
+        return len(rows)
@@ -0,0 +1,232 @@
+import sqlite3, threading, time, os, secrets
+from collections import OrderedDict
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SecureCookieSession
+from itsdangerous import Signer, BadSignature
+
+
+class LocalStore:
+    # sid -> (expires, payload), private to this process. Only correct with
+    # a single worker; stands in for an external KV in development.
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def generation(self):
+        # nothing outside this process can write
+        return 0
+
+    def get(self, sid):
+        entry = self._data.get(sid)
+        if entry and entry[0] > time.time():
+            return entry[1]
+        return None
+
+    def set(self, sid, payload, ttl):
+        with self._lock:
+            self._data[sid] = (time.time() + ttl, payload)
+            if len(self._data) % 1000 == 0:
+                self.purge()
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+    def purge(self):
+        now = time.time()
+        for sid in [sid for sid, (expires, _) in self._data.items() if expires <= now]:
+            del self._data[sid]
+
+
+class SQLiteStore:
+    # Sessions shared by every worker through a small SQLite file, kept
+    # apart from the main database so session writes never queue behind
+    # order writes. Expired rows are purged every `purge_every` seconds.
+
+    def __init__(self, path, purge_every=600):
+        self.path = path
+        self.purge_every = purge_every
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _connect(self):
+        # opened lazily so a connection never crosses a gunicorn fork
+        if self._pid == os.getpid():
+            return
+        self._conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                sid TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                expires REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires)")
+        self._purged = time.time()
+        self._pid = os.getpid()
+
+    def generation(self):
+        # PRAGMA data_version moves when another process commits; our own
+        # writes go through the hot cache anyway
+        with self._lock:
+            self._connect()
+            return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def get(self, sid):
+        with self._lock:
+            self._connect()
+            row = self._conn.execute(
+                "SELECT payload FROM sessions WHERE sid = ? AND expires > ?",
+                (sid, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, sid, payload, ttl):
+        with self._lock:
+            self._connect()
+            now = time.time()
+            self._conn.execute("""
+                INSERT INTO sessions (sid, payload, expires) VALUES (?, ?, ?)
+                ON CONFLICT(sid) DO UPDATE SET payload = excluded.payload, expires = excluded.expires
+            """, (sid, payload, now + ttl))
+            if now - self._purged > self.purge_every:
+                self._conn.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+                self._purged = now
+
+    def delete(self, sid):
+        with self._lock:
+            self._connect()
+            self._conn.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+
+class ServerSession(SecureCookieSession):
+
+    def __init__(self, initial=None, sid=None, new=False):
+        super().__init__(initial)
+        self.sid = sid
+        self.new = new
+        self.replaced = None
+
+    def regenerate(self):
+        # Move the data to a fresh id when the user logs in or out, so an
+        # id planted in the browser beforehand (session fixation) is worth
+        # nothing afterwards. save_session() deletes the old entry.
+        if not self.new and self.replaced is None:
+            self.replaced = self.sid
+        self.sid = secrets.token_urlsafe(16)
+        self.new = True
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    # The cookie carries only a signed random id (~50 bytes); the session
+    # dict lives in `store` for `ttl` seconds after its last write. Payloads
+    # are kept in an in-process LRU that is dropped whenever the store
+    # reports a write from another process, so a hit skips the store.
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, ttl=7 * 24 * 3600, hot_size=2048):
+        self.store = store
+        self.ttl = ttl
+        self.hot_size = hot_size
+        self._hot = OrderedDict()       # sid -> serialized payload
+        self._seen = None
+        self._lock = threading.Lock()
+        self._stats = {"hot_hits": 0, "loads": 0, "writes": 0}
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt="session-id")
+
+    def _load(self, sid):
+        generation = self.store.generation()
+        with self._lock:
+            if generation != self._seen:
+                self._hot.clear()
+                self._seen = generation
+            if sid in self._hot:
+                self._hot.move_to_end(sid)
+                self._stats["hot_hits"] += 1
+                return self.serializer.loads(self._hot[sid])
+            self._stats["loads"] += 1
+
+        payload = self.store.get(sid)
+        if payload is None:
+            return None
+        self._remember(sid, payload)
+        return self.serializer.loads(payload)
+
+    def _remember(self, sid, payload):
+        with self._lock:
+            if payload is None:
+                self._hot.pop(sid, None)
+                return
+            self._hot[sid] = payload
+            self._hot.move_to_end(sid)
+            while len(self._hot) > self.hot_size:
+                self._hot.popitem(last=False)
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            if sid:
+                data = self._load(sid)
+                if data is not None:
+                    return ServerSession(data, sid=sid)
+        return ServerSession(sid=secrets.token_urlsafe(16), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        rotated = session.replaced is not None
+        if rotated:
+            self.store.delete(session.replaced)
+            self._remember(session.replaced, None)
+            session.replaced = None
+
+        if not session:
+            if session.modified and (rotated or not session.new):
+                self.store.delete(session.sid)
+                self._remember(session.sid, None)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.accessed:
+            response.vary.add("Cookie")
+        if not session.modified:
+            return
+
+        payload = self.serializer.dumps(dict(session))
+        self.store.set(session.sid, payload, self.ttl)
+        self._remember(session.sid, payload)
+        with self._lock:
+            self._stats["writes"] += 1
+
+        response.set_cookie(
+            name,
+            self._signer(app).sign(session.sid).decode(),
+            max_age=self.ttl,
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            httponly=self.get_cookie_httponly(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["hot"] = len(self._hot)
+        data["backend"] = type(self.store).__name__
+        return data
@@ -0,0 +1,147 @@
+import random, sqlite3, sys, time
+
+
+class OutOfStock(Exception):
+
+    # args stay (product_id,) so the error pickles across the writer socket
+    def __init__(self, product_id):
+        super().__init__(product_id)
+        self.product_id = product_id
+
+    def __str__(self):
+        return "not enough stock for product %d" % self.product_id
+
+
+def is_busy(exc):
+    # SQLITE_BUSY / SQLITE_LOCKED surface as OperationalError
+    message = str(exc).lower()
+    return isinstance(exc, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+
+def with_retry(db, fn, attempts=5, base=0.02, cap=0.5):
+    # Run fn() (which opens and commits its own transaction) and retry it
+    # when SQLite reports the database busy, sleeping a random time up to
+    # base * 2**n so waiting writers don't all come back at once.
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except sqlite3.OperationalError as exc:
+            if db.in_transaction:
+                db.rollback()
+            if not is_busy(exc) or attempt == attempts - 1:
+                raise
+            time.sleep(random.uniform(0, min(cap, base * 2 ** attempt)))
+
+
+def reserve(db, cart):
+    # Take `cart` ({product_id: quantity}) out of stock inside the caller's
+    # write transaction. Each row is decremented only if enough is left;
+    # zero rows back means another buyer got there first and OutOfStock is
+    # raised for the caller to roll back. Rows are locked in id order.
+    left = {}
+    for product_id in sorted(cart):
+        row = db.execute("""
+            UPDATE products
+            SET availability = availability - ?
+            WHERE id = ? AND availability >= ?
+            RETURNING availability
+        """, (cart[product_id], product_id, cart[product_id])).fetchone()
+        if row is None:
+            raise OutOfStock(product_id)
+        left[product_id] = row[0]
+    return left
+
+
+def release(db, items):
+    # put (product_id, quantity) pairs back, e.g. when an order is cancelled
+    db.executemany(
+        "UPDATE products SET availability = availability + ? WHERE id = ?",
+        [(quantity, product_id) for product_id, quantity in items]
+    )
+
+
+# ================= STRESS TEST =================
+# python stock.py [processes] [buyers per process] [stock]
+# Many processes buy one product at once through app.place_order; the run
+# fails unless units sold + units left == starting stock and every unit
+# sold belongs to an order a buyer was told about (calls that failed with a
+# database error may or may not have gone through).
+
+def _buyer(path, product_id, customer_id, buys, results, go, done):
+    import os
+    os.environ["DATABASE"] = path
+    os.environ["SESSION_BACKEND"] = "local"
+    import app
+    results.put("ready")
+    go.wait()
+    ok = sold_out = busy = 0
+    for _ in range(buys):
+        try:
+            order, error = app.place_order(customer_id, {product_id: 1})
+        except sqlite3.OperationalError:
+            busy += 1
+            continue
+        if order:
+            ok += 1
+        elif error == "not_enough_quantity":
+            sold_out += 1
+    results.put((ok, sold_out, busy))
+    # stay up like a gunicorn worker would: with WRITE_MODE=socket one of
+    # these processes is the writer for the others
+    done.wait()
+
+
+def stress(processes=16, buys=50, stock=200):
+    import multiprocessing, tempfile, os
+    from db import init_db
+
+    path = os.path.join(tempfile.mkdtemp(), "stress.db")
+    init_db(path)
+    db = sqlite3.connect(path)
+    db.execute("INSERT INTO users (username, password, role) VALUES ('owner', '-', 'owner')")
+    db.execute("INSERT INTO users (username, password, role) VALUES ('buyer', '-', 'customer')")
+    db.execute("INSERT INTO stalls (owner_id, stall_name) VALUES (1, 'stress')")
+    product_id = db.execute("""
+        INSERT INTO products (stall_id, product_name, price, prep_time, availability)
+        VALUES (1, 'last one', 10, 1, ?)
+    """, (stock,)).lastrowid
+    db.commit()
+
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    go, done = ctx.Event(), ctx.Event()
+    workers = [
+        ctx.Process(target=_buyer, args=(path, product_id, 2, buys, results, go, done))
+        for _ in range(processes)
+    ]
+    for w in workers:
+        w.start()
+    for _ in workers:
+        results.get()
+    # timed from the moment every buyer has imported the app
+    started = time.perf_counter()
+    go.set()
+    totals = [results.get() for _ in workers]
+    done.set()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - started
+
+    ok = sum(t[0] for t in totals)
+    busy = sum(t[2] for t in totals)
+    left = db.execute("SELECT availability FROM products WHERE id=?", (product_id,)).fetchone()[0]
+    sold = db.execute("SELECT COALESCE(SUM(quantity), 0) FROM order_items WHERE product_id=?", (product_id,)).fetchone()[0]
+    db.close()
+
+    print("attempts %d, orders %d, sold out %d, busy %d, %.2fs (%.0f attempts/s)" % (
+        processes * buys, ok, sum(t[1] for t in totals), busy, elapsed, processes * buys / elapsed))
+    print("stock %d, sold %d, left %d" % (stock, sold, left))
+    assert left >= 0, "negative stock"
+    assert sold + left == stock, "oversold"
+    assert ok <= sold <= ok + busy, "orders lost or duplicated"
+    print("No oversell")
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    stress(*args)
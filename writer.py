@@ -0,0 +1,215 @@
+import fcntl, os, queue, sqlite3, threading, time
+from concurrent.futures import Future
+from multiprocessing.connection import Listener, Client
+from pool import PRAGMAS
+from stock import with_retry
+
+
+class Writer:
+    # Runs write commands: functions fn(db, *args) registered with
+    # @writer.command that do their writes without committing. Results
+    # (and exceptions) must pickle, because in socket mode they cross
+    # processes.
+    #
+    # mode="direct"  every call is its own BEGIN IMMEDIATE on a pooled
+    #                connection, retried while the database is busy
+    # mode="thread"  one writer thread per process owns a connection and
+    #                group-commits up to `batch` queued commands in one
+    #                transaction, each inside its own SAVEPOINT so a failing
+    #                command only undoes itself
+    # mode="socket"  one process (whichever holds `socket_path`.lock) runs
+    #                the writer thread and serves the other workers over a
+    #                unix socket, so every write in the app goes through one
+    #                connection and nobody waits on the database lock
+
+    def __init__(self, pool, mode="direct", batch=64, socket_path="writer.sock", authkey=b"takego"):
+        self.pool = pool
+        self.mode = mode
+        self.batch = batch
+        self.socket_path = socket_path
+        self.authkey = authkey
+        self.commands = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = None
+        self._queue = None
+        self._stats = {"commands": 0, "batches": 0, "errors": 0, "max_batch": 0, "role": mode}
+
+    def command(self, fn):
+        self.commands[fn.__name__] = fn
+        return fn
+
+    def run(self, fn, *args):
+        # fn is a registered command; returns its result or raises its error
+        if self.mode == "direct":
+            return self._direct(fn, args)
+        self._start()
+        if self._queue is not None:
+            return self._submit(fn.__name__, args).result()
+        return self._remote(fn.__name__, args)
+
+    # ---------- direct ----------
+
+    def _direct(self, fn, args):
+        with self.pool.connection() as db:
+            def tx():
+                db.execute("BEGIN IMMEDIATE")
+                result = fn(db, *args)
+                db.commit()
+                return result
+            try:
+                return with_retry(db, tx)
+            except Exception:
+                if db.in_transaction:
+                    db.rollback()
+                raise
+
+    # ---------- writer thread ----------
+
+    def _start(self):
+        # once per process: become the writer, or (socket mode) a client of it
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = None
+            self._local = threading.local()
+            if self.mode == "thread" or self._become_host():
+                self._queue = queue.Queue()
+                threading.Thread(target=self._writer, name="db-writer", daemon=True).start()
+                self._stats["role"] = "writer" if self.mode == "socket" else "thread"
+            else:
+                self._stats["role"] = "client"
+            self._pid = os.getpid()
+
+    def _submit(self, name, args):
+        future = Future()
+        self._queue.put((name, args, future))
+        return future
+
+    def _connect(self):
+        db = sqlite3.connect(self.pool.path, timeout=self.pool.timeout, isolation_level=None, check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            db.execute(pragma)
+        return db
+
+    def _writer(self):
+        db = self._connect()
+        while True:
+            jobs = [self._queue.get()]
+            while len(jobs) < self.batch:
+                try:
+                    jobs.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                outcomes = with_retry(db, lambda: self._commit(db, jobs))
+            except Exception as exc:
+                # the batch itself could not commit: every caller gets the error
+                outcomes = [(None, exc)] * len(jobs)
+            for (_, _, future), (result, error) in zip(jobs, outcomes):
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+    def _commit(self, db, jobs):
+        outcomes = []
+        db.execute("BEGIN IMMEDIATE")
+        for name, args, _ in jobs:
+            db.execute("SAVEPOINT job")
+            try:
+                outcomes.append((self.commands[name](db, *args), None))
+                db.execute("RELEASE job")
+            except Exception as exc:
+                db.execute("ROLLBACK TO job")
+                db.execute("RELEASE job")
+                outcomes.append((None, exc))
+        db.execute("COMMIT")
+        with self._lock:
+            self._stats["commands"] += len(jobs)
+            self._stats["batches"] += 1
+            self._stats["errors"] += sum(1 for _, e in outcomes if e is not None)
+            self._stats["max_batch"] = max(self._stats["max_batch"], len(jobs))
+        return outcomes
+
+    # ---------- socket ----------
+
+    def _become_host(self):
+        # the lock is held for the life of the process, so a dead writer
+        # frees it and the next client to notice takes over
+        self._lockfile = open(self.socket_path + ".lock", "w")
+        try:
+            fcntl.flock(self._lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lockfile.close()
+            return False
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        listener = Listener(self.socket_path, family="AF_UNIX", authkey=self.authkey)
+        threading.Thread(target=self._serve, args=(listener,), name="db-writer-socket", daemon=True).start()
+        return True
+
+    def _serve(self, listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception:
+                continue
+            threading.Thread(target=self._serve_client, args=(conn,), daemon=True).start()
+
+    def _serve_client(self, conn):
+        # one connection per client thread; requests on it are sequential
+        with conn:
+            while True:
+                try:
+                    name, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                future = self._submit(name, args)
+                try:
+                    conn.send((True, future.result()))
+                except Exception as exc:
+                    conn.send((False, exc))
+
+    def _remote(self, name, args):
+        # a command is only resent if it never reached the writer; once sent,
+        # a lost reply is an error because the write may have committed
+        for attempt in range(50):
+            conn = getattr(self._local, "conn", None)
+            try:
+                if conn is None:
+                    conn = self._local.conn = Client(self.socket_path, family="AF_UNIX", authkey=self.authkey)
+                conn.send((name, args))
+            except (OSError, EOFError):
+                # writer not up yet, or its process died: reconnect, or take over
+                self._local.conn = None
+                if attempt and self._takeover():
+                    return self._submit(name, args).result()
+                time.sleep(0.1)
+                continue
+            try:
+                ok, value = conn.recv()
+            except (OSError, EOFError):
+                self._local.conn = None
+                raise sqlite3.OperationalError("database writer went away; write may not have been applied")
+            if ok:
+                return value
+            raise value
+        raise sqlite3.OperationalError("database writer unavailable")
+
+    def _takeover(self):
+        with self._lock:
+            if self._queue is None and self._become_host():
+                self._queue = queue.Queue()
+                threading.Thread(target=self._writer, name="db-writer", daemon=True).start()
+                self._stats["role"] = "writer"
+        return self._queue is not None
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+        data["queued"] = self._queue.qsize() if self._queue is not None else 0
+        return data